@@ -1,25 +1,55 @@
 #!/usr/bin/python3
 # Requiere xdotool, python3-tk
-import subprocess
-import threading
-import queue
-import logging
-import json
-import sys
-import os
-try:
-    import Tkinter as tk
-    import tkFont
-    import ttk
-except ImportError:  # Python 3
-    import tkinter as tk
-    import tkinter.font as tkFont
-    import tkinter.ttk as ttk
-
-# Get arguments
+import time
+# imports timed from here, see report_startup()
+START_TIME = time.monotonic()
+import select  # noqa: E402
+import selectors  # noqa: E402
+import threading  # noqa: E402
+import queue  # noqa: E402
+import logging  # noqa: E402
+import json  # noqa: E402
+import marshal  # noqa: E402
+import sys  # noqa: E402
+import os  # noqa: E402
+import resource  # noqa: E402
+import struct  # noqa: E402
+import math  # noqa: E402
+import signal  # noqa: E402
+import stat  # noqa: E402
+import atexit  # noqa: E402
+import bisect  # noqa: E402
+from array import array  # noqa: E402
+from collections import deque, namedtuple  # noqa: E402
+IMPORTS_TIME = time.monotonic()
+
+# GUI modules, imported by import_tk() only when the GUI is used
+tk = None
+tkFont = None
+ttk = None
+tkSimpleDialog = None
+# imported by the XTest output backend
+ctypes = None
+
+
+def import_tk():
+    global tk, tkFont, ttk, tkSimpleDialog
+    try:
+        import Tkinter as tk
+        import tkFont
+        import ttk
+        import tkSimpleDialog
+    except ImportError:  # Python 3
+        import tkinter as tk
+        import tkinter.font as tkFont
+        import tkinter.ttk as ttk
+        import tkinter.simpledialog as tkSimpleDialog
+
+
+# Get arguments (when imported, e.g. by the benchmarks, keep the defaults)
 options = []
 files = []
-if len(sys.argv) > 1:
+if __name__ == '__main__':
     for i in sys.argv[1:]:
         if i.startswith('-'):
             options.append(i)
@@ -29,159 +59,2519 @@ if len(sys.argv) > 1:
 opt_desc = {
     '--abs':
         'Absolute mode : usefull to assign many keys to one pot controller',
+    '--channels':
+        'Programming mode binds the keys of the MIDI channel they come from',
+    '--output=xdotool|xtest|null':
+        'Keystroke output backend (default: xdotool)',
+    '--headless':
+        'Run without GUI, using the saved configuration',
+    '--device=/dev/midi1,/dev/midi2':
+        'MIDI devices to open (default: first one found)',
+    '--cc-window=ms':
+        'Merge the keys of a controller moved within this time (default: 0)',
+    '--mouse-rate=60':
+        'Mouse moves and scrolls sent per second at most (default: 60)',
+    '--chord-window=ms':
+        'Max time between the notes of a chord (default: 30)',
+    '--profile=name':
+        'Layer used when no other one is selected (default: base layer)',
+    '--follow-window':
+        'Use the layer named after the class of the active window',
+    '--queue=latest|drop-oldest|block':
+        'When the messages read are not handled in time: drop the oldest '
+        'ones, but keep the last value of a controller (default), drop the '
+        'oldest ones, or stop reading',
+    '--queue-size=4096':
+        'Messages waiting to be handled at most',
+    '--max-age=ms':
+        'Drop the messages waiting longer, 0 to keep them (default: 1000)',
+    '--latency':
+        'Measure latencies, reported at exit and on SIGUSR1',
+    '--record=session.m2dt':
+        'Save the raw MIDI stream with its timing',
+    '--replay=session.m2dt':
+        'Play a saved session instead of reading a device',
+    '--replay-speed=1.0|max':
+        'Replay speed factor, max for no delays (default: 1.0)',
     './config.json':
         'Path to configuration file'
 }
 
+
+def import_ctypes():
+    global ctypes
+    import ctypes
+    import ctypes.util
+
+
+def get_option(name, default=None):
+    prefix = name + '='
+    for opt in options:
+        if opt.startswith(prefix):
+            return opt[len(prefix):]
+    return default
+
+
 if '--help' in options or '-h' in options:
     print('Usage :' + sys.argv[0] + ' ' +
           ' '.join(map(lambda a: '[%s]' % a, opt_desc.keys())))
     for (k, v) in opt_desc.items():
-        print("{0:<14s} {1:s}".format(k, v))
+        print("{0:<28s} {1:s}".format(k, v))
     exit()
 ABSOLUTE_CTL = ('--abs' in options)
+CHANNEL_KEYS = ('--channels' in options)
+OUTPUT_BACKEND = get_option('--output', 'xdotool')
+HEADLESS = ('--headless' in options)
+LATENCY_STATS = ('--latency' in options)
+CC_WINDOW = float(get_option('--cc-window', 0)) / 1000
+MOUSE_RATE = float(get_option('--mouse-rate', 60))
+CHORD_WINDOW = float(get_option('--chord-window', 30)) / 1000
+PROFILE = get_option('--profile', '')
+FOLLOW_WINDOW = ('--follow-window' in options)
+RECORD_FILE = get_option('--record')
+REPLAY_FILE = get_option('--replay')
+REPLAY_SPEED = get_option('--replay-speed', '1.0')
+REPLAY_SPEED = 0 if REPLAY_SPEED == 'max' else float(REPLAY_SPEED)
+MIDI_QUEUE_POLICY = get_option('--queue', 'latest')
+MIDI_QUEUE_SIZE = int(get_option('--queue-size', 4096))
+MIDI_MAX_AGE = float(get_option('--max-age', 1000)) / 1000
+DEVICES = [d for d in (get_option('--device') or '').split(',') if d]
 DEFAULT_CONFIG_FILE = (len(files) > 0 and
                        files[0] or
-                       os.path.dirname(sys.argv[0]) + '/configs.json')
+                       os.path.join(
+                           os.path.dirname(os.path.abspath(__file__)),
+                           'configs.json'))
 DEFAULT_CONFIG_FORMAT = 'json'
 
 # Sensitivity settings
-# Notes are in range [0,127]
+# Notes are in range [0,127]: velocities above MIDDLE are "middle", above
+# STRONG "strong" (default velocity layers of the notes)
 NOTE_PRESSURE_MIDDLE = 64
-NOTE_PRESSURE_STRONG = 63
+NOTE_PRESSURE_STRONG = 96
+# default zones of the controllers in absolute mode
+CC_ZONE_COUNT = 10
 
 # CONSTANTS <<12
 NOTE_PRESSURE_MIDDLE_DELTA = 0x2
 NOTE_PRESSURE_STRONG_DELTA = 0x3
 
+# Bindings
+UNDEFINED_KEY = '<<Undefined>>'
+ALL_DEVICES = 'All devices'
+BASE_LAYER = 'Base layer'
+# key of the bindings switching to a layer: 'layer:name'; state 0 while
+# the MIDI key is held, state 1 toggled by each hit
+LAYER_PREFIX = 'layer:'
+# key of the macro bindings: 'macro:' then steps separated by spaces,
+# 'Mod+Key' hits the key, 'keydown:Key' and 'keyup:Key' press and release
+# it, '100ms' waits
+MACRO_PREFIX = 'macro:'
+# key of the command bindings: 'exec:' then a shell command
+COMMAND_PREFIX = 'exec:'
+# key of the mouse bindings: 'mouse:x 2.5' and 'mouse:y -1' move the
+# pointer (pixels, fractions add up), 'mouse:scroll 1' and 'mouse:hscroll
+# -1' scroll (down and right when positive), 'mouse:button 1' presses a
+# button
+MOUSE_PREFIX = 'mouse:'
+MOUSE_AXES = ('x', 'y', 'scroll', 'hscroll')
+# events of the 'mouse:button' bindings
+MOUSE_BUTTON_EVENTS = {
+    'key': 'click', 'keydown': 'mousedown', 'keyup': 'mouseup'}
+# seconds between two checks of the active window
+WINDOW_POLL_INTERVAL = 0.5
+# optional fields of a binding in configs.json
+# rate: max keys per second, overflow: 'drop' (default) or 'accumulate'
+# zones: for the notes and the absolute controllers, a count of equal
+# zones or the lowest value of each zone but the first (at most 15 zones),
+# hysteresis: values kept in the previous zone beyond its bounds
+# retrigger: for the macros, 'cancel' (default) to restart a macro hit
+# while it plays, 'queue' to play it again once done
+# timeout: for the commands, seconds before they are killed (default:
+# COMMAND_TIMEOUT), concurrency: runs of the command at once (default: 1)
+BINDING_OPTIONS = ('rate', 'overflow', 'zones', 'hysteresis', 'retrigger',
+                   'timeout', 'concurrency')
+# encoded keys are below 0xB80 << 1 (relative CC), or 0xB80 | 10 << 12
+KEYMAP_SIZE = 0x10000
+# bindings of a single channel: key | (channel + 1) << CHANNEL_SHIFT, the
+# other ones apply to all channels
+CHANNEL_SHIFT = 16
+# key state of a device: one slot per channel << 7 | note (or controller)
+STATE_SIZE = 16 << 7
+# no value received yet
+NO_VALUE = 0xFF
+# zone tables (see zone_table): 16 rows of 128 values
+ZONE_TABLE_SIZE = 16 << 7
+# chords are bound to CHORD_KEY | bitset of their notes (1 << note)
+CHORD_KEY = 1 << 128
+
+# Compiled bindings, saved next to the configuration file
+CONFIG_CACHE_SUFFIX = '.cache'
+CONFIG_CACHE_VERSION = 9
+# seconds between two checks of the configuration file
+CONFIG_POLL_INTERVAL = 1.0
+# rows scrolled by a step of the mouse wheel
+TREE_WHEEL_ROWS = 3
+
+# events waiting for the output worker beyond which only keyups are kept
+OUTPUT_QUEUE_SIZE = 1024
+# events releasing a key or a button, kept when the output is late
+RELEASE_EVENTS = ('keyup', 'mouseup')
+# seconds an xdotool call may take before it is killed
+XDOTOOL_TIMEOUT = 2.0
+
+# Commands run by the bindings: threads, and commands waiting for one of
+# them beyond which new ones are dropped
+COMMAND_WORKERS = 4
+COMMAND_QUEUE_SIZE = 16
+COMMAND_TIMEOUT = 10.0
+
+# Device reader settings
+READ_BUFFER_SIZE = 1024
+# seconds before opening a lost device again, doubled after each failed
+# attempt up to RECONNECT_MAX_DELAY
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 2.0
+# status of the message queued when a device is closed or lost (MIDI
+# System Reset): the keys it holds are released
+DEVICE_RESET = 0xFF
+
+
+# time: time.monotonic() when the message was read from the device
+# device: the device (path) the message comes from
+MidiMessage = namedtuple(
+    'MidiMessage', ['status', 'data1', 'data2', 'time', 'device'])
+
+
+def is_release(message):
+    # note-off, note-on with velocity 0, or device reset
+    return (message[0] & 0xF0 == 0x80 or
+            message[0] & 0xF0 == 0x90 and message[2] == 0 or
+            message[0] == DEVICE_RESET)
+
+
+# card, device: ALSA numbers (None if unknown), name: from the driver
+MidiDevice = namedtuple('MidiDevice', ['path', 'name', 'card', 'device'])
+
+# cmd  meaning        #par param 1    param 2
+# ----+--------------+----+----------+-------
+# 0x80 Note-off       2    key        velocity
+# 0x90 Note-on        2    key        velocity
+# 0xA0 Aftertouch     2    key        touch
+# 0xB0 Continuous
+#      Controller     2    controller value
+# 0xC0 Patch change   1    instrument
+# 0xD0 Channel
+#      Pressure       1    pressure
+# 0xE0 Pitch bend     2    lsb(7bits) msb(7bits)
+# 0xF0 (non-musical commands)
+# Data bytes expected after a status byte, indexed by status >> 4 (channel
+# messages) or by status & 0xF (system common messages, 0xF0..0xF7)
+CHANNEL_DATA_LENGTH = (0, 0, 0, 0, 0, 0, 0, 0, 2, 2, 2, 2, 1, 1, 2, 0)
+SYSTEM_DATA_LENGTH = (0, 1, 2, 1, 0, 0, 0, 0)
+
+
+class MidiParser(object):
+    # Incremental MIDI byte stream parser.
+    # Handles running status, skips SysEx and system common messages, and
+    # lets realtime bytes (0xF8..0xFF) through without breaking the message
+    # in progress. Realtime messages are only yielded if `realtime` is set.
+
+    def __init__(self, realtime=False, source=None):
+        self.realtime = realtime
+        self.source = source
+        self.reset()
+
+    def reset(self):
+        self._status = 0
+        self._expected = 0
+        self._data1 = -1
+        self._sysex = False
+
+    def feed(self, data, length=None, timestamp=0.0):
+        if length is None:
+            length = len(data)
+        status = self._status
+        expected = self._expected
+        data1 = self._data1
+        sysex = self._sysex
+        source = self.source
+        try:
+            for i in range(length):
+                byte = data[i]
+                if byte < 0x80:
+                    if sysex or not status:
+                        continue
+                    if expected == 1:
+                        if status < 0xF0:
+                            yield MidiMessage(
+                                status, byte, 0, timestamp, source)
+                        else:
+                            status = 0
+                    elif data1 < 0:
+                        data1 = byte
+                    else:
+                        if status < 0xF0:
+                            yield MidiMessage(
+                                status, data1, byte, timestamp, source)
+                        else:
+                            status = 0
+                        data1 = -1
+                elif byte < 0xF0:
+                    status = byte
+                    expected = CHANNEL_DATA_LENGTH[byte >> 4]
+                    data1 = -1
+                    sysex = False
+                elif byte >= 0xF8:
+                    if self.realtime:
+                        yield MidiMessage(byte, 0, 0, timestamp, source)
+                elif byte == 0xF0:
+                    status = 0
+                    sysex = True
+                else:
+                    # system common message: cancels running status
+                    sysex = False
+                    data1 = -1
+                    expected = SYSTEM_DATA_LENGTH[byte & 0x7]
+                    status = expected and byte or 0
+        finally:
+            self._status = status
+            self._expected = expected
+            self._data1 = data1
+            self._sysex = sysex
+
+
+class LatencyStats(object):
+    # Rolling latency windows per stage: the last WINDOW samples are kept in
+    # a ring buffer, percentiles are only computed when reported.
+
+    # total: from the read to the hand over to the output worker, output:
+    # from the hand over to the keystrokes sent
+    STAGES = ('parse', 'queue', 'translate', 'dispatch', 'total', 'output')
+    WINDOW = 4096
+
+    def __init__(self):
+        self._samples = {}
+        self._index = {}
+        self._count = {}
+        self._max = {}
+        for stage in self.STAGES:
+            self._samples[stage] = array('d', bytes(8 * self.WINDOW))
+            self._index[stage] = 0
+            self._count[stage] = 0
+            self._max[stage] = 0.0
+
+    def add(self, stage, seconds):
+        i = self._index[stage]
+        self._samples[stage][i] = seconds
+        self._index[stage] = (i + 1) % self.WINDOW
+        self._count[stage] += 1
+        if seconds > self._max[stage]:
+            self._max[stage] = seconds
+
+    def summary(self, stage):
+        # (count, p50, p99, max) in seconds
+        count = self._count[stage]
+        if not count:
+            return (0, 0.0, 0.0, 0.0)
+        window = sorted(self._samples[stage][:min(count, self.WINDOW)])
+        return (count,
+                window[int(len(window) * 0.5)],
+                window[min(len(window) - 1, int(len(window) * 0.99))],
+                self._max[stage])
+
+    def report(self):
+        lines = []
+        for stage in self.STAGES:
+            (count, p50, p99, top) = self.summary(stage)
+            lines.append(
+                "{0:<10s} n={1:<8d} p50={2:.3f}ms p99={3:.3f}ms "
+                "max={4:.3f}ms".format(
+                    stage, count, p50 * 1e3, p99 * 1e3, top * 1e3))
+        return lines
+
+    def dump(self, *args):
+        for line in self.report():
+            logging.info("latency %s", line)
+
+
+def scan_dir(path):
+    # entries of `path`, none if it can not be read
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except OSError:
+        return []
+
+
+def asound_rawmidi():
+    # (card, device) -> name of the ALSA rawmidi devices
+    names = {}
+    for card in scan_dir('/proc/asound'):
+        if not (card.name.startswith('card') and card.name[4:].isdigit()):
+            continue
+        for entry in scan_dir(card.path):
+            if not (entry.name.startswith('midi') and
+                    entry.name[4:].isdigit()):
+                continue
+            try:
+                with open(entry.path) as f:
+                    name = f.readline().strip()
+            except OSError:
+                name = ''
+            names[(int(card.name[4:]), int(entry.name[4:]))] = name
+    return names
+
+
+def midi_device_numbers(name):
+    # ALSA (card, device) of a device file, (None, None) if unknown
+    if name.startswith('midiC'):
+        numbers = name[5:].split('D')
+    elif name.startswith(('midi', 'dmmidi')):
+        numbers = [name.split('midi', 1)[1] or '0', '0']
+    else:
+        numbers = []
+    if len(numbers) == 2 and numbers[0].isdigit() and numbers[1].isdigit():
+        return (int(numbers[0]), int(numbers[1]))
+    return (None, None)
+
+
+def find_midi_devices():
+    # MIDI devices of /dev (OSS emulation: midiN, card N) and /dev/snd
+    # (midiCcDd), named after /proc/asound
+    names = None
+    devices = []
+    for directory in ('/dev', '/dev/snd'):
+        for entry in scan_dir(directory):
+            if 'midi' not in entry.name or entry.is_dir():
+                continue
+            if names is None:
+                names = asound_rawmidi()
+            (card, device) = midi_device_numbers(entry.name)
+            devices.append(MidiDevice(
+                entry.path, names.get((card, device), ''), card, device))
+    logging.debug('MIDI devices: %s', devices)
+    return devices
+
+
+class MessageQueue(object):
+    # Ring buffer of the messages between the reader thread and the
+    # consumer. When `size` messages are waiting, `policy` is
+    #   'block': the reader waits for the consumer, the devices keep the
+    #   bytes meanwhile
+    #   'drop-oldest': the oldest message is dropped
+    #   'latest': a controller message replaces the one of its controller
+    #   still waiting, else the oldest message is dropped
+    # Releases are never dropped, so that no key stays pressed: the ones
+    # pushed out are read first. Messages waiting longer than `max_age`
+    # seconds (0: no limit) are dropped when read. `wakeup` is called
+    # before waiting for the consumer, which may not know yet there are
+    # messages to read. Once closed, a full 'block' queue drops the new
+    # messages, but a DEVICE_RESET pushes the oldest one out.
+
+    POLICIES = ('block', 'drop-oldest', 'latest')
+
+    def __init__(self, size=None, policy=None, max_age=None, wakeup=None):
+        self.size = size or MIDI_QUEUE_SIZE
+        self.wakeup = wakeup
+        self.policy = policy or MIDI_QUEUE_POLICY
+        if self.policy not in self.POLICIES:
+            raise ValueError('unknown queue policy: %r' % self.policy)
+        self.max_age = MIDI_MAX_AGE if max_age is None else max_age
+        self.high_water = 0
+        self.dropped = 0
+        self.replaced = 0
+        self.stale = 0
+        self.blocked = 0
+        self._ring = [None] * self.size
+        # index of the oldest message, and count of messages waiting
+        self._head = 0
+        self._count = 0
+        # (device, status, controller) -> index of its last message, for
+        # the 'latest' policy
+        self._controllers = {}
+        # releases pushed out of the ring
+        self._releases = []
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, message):
+        with self._cond:
+            controller = None
+            if self.policy == 'latest' and message[0] & 0xF0 == 0xB0:
+                controller = (message.device, message[0], message[1])
+                if self._count == self.size:
+                    index = self._controllers.get(controller)
+                    if index is not None:
+                        self._ring[index] = message
+                        self.replaced += 1
+                        return
+            if self._count == self.size:
+                if self.policy == 'block':
+                    self.blocked += 1
+                    if self.wakeup is not None:
+                        self.wakeup()
+                    while self._count == self.size and not self._closed:
+                        self._cond.wait()
+                    if self._closed:
+                        if message[0] != DEVICE_RESET:
+                            self.dropped += 1
+                            return
+                        # the keys of a device closed are released anyway
+                        self._drop_oldest()
+                else:
+                    self._drop_oldest()
+            index = (self._head + self._count) % self.size
+            self._ring[index] = message
+            self._count += 1
+            if controller is not None:
+                self._controllers[controller] = index
+            if self._count > self.high_water:
+                self.high_water = self._count
+
+    def _drop_oldest(self):
+        oldest = self._ring[self._head]
+        if is_release(oldest):
+            self._releases.append(oldest)
+        else:
+            self.dropped += 1
+        if self._controllers and oldest[0] & 0xF0 == 0xB0:
+            controller = (oldest.device, oldest[0], oldest[1])
+            if self._controllers.get(controller) == self._head:
+                del self._controllers[controller]
+        self._head = (self._head + 1) % self.size
+        self._count -= 1
+
+    def read(self):
+        # the messages waiting, oldest first
+        with self._cond:
+            (head, count) = (self._head, self._count)
+            if self._releases:
+                messages = self._releases
+                self._releases = []
+            else:
+                messages = []
+            if head + count <= self.size:
+                messages.extend(self._ring[head:head + count])
+            else:
+                messages.extend(self._ring[head:])
+                messages.extend(self._ring[:head + count - self.size])
+            self._head = (head + count) % self.size
+            self._count = 0
+            self._controllers.clear()
+            if self.policy == 'block':
+                self._cond.notify_all()
+        if self.max_age and messages:
+            # any message can be stale: 'latest' refreshes old slots, and
+            # the releases pushed out come first
+            cutoff = time.monotonic() - self.max_age
+            kept = [message for message in messages
+                    if message.time >= cutoff or is_release(message)]
+            if len(kept) < len(messages):
+                self.stale += len(messages) - len(kept)
+                messages = kept
+        return messages
+
+    def counters(self):
+        return {
+            'midi max queued': self.high_water,
+            'midi dropped': self.dropped,
+            'midi replaced': self.replaced,
+            'midi stale': self.stale,
+            'midi blocked': self.blocked,
+        }
+
+    def open(self):
+        with self._cond:
+            self._closed = False
+
+    def close(self):
+        # a blocked reader gives up its message
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+def drain_pipe(fd):
+    # read a non-blocking self-pipe until it is empty
+    try:
+        while os.read(fd, READ_BUFFER_SIZE):
+            pass
+    except (BlockingIOError, OSError):
+        pass
+
 
 class MidiKeyboard(object):
+    # Reads any number of devices from a single thread multiplexing them
+    # with a selector. Devices join and leave with add_device() and
+    # remove_device(); the thread stops when the last device is gone.
+    # The messages wait in a MessageQueue, read() returns them all.
+    # A device node (character device) lost to an end of stream or a read
+    # error, e.g. unplugged, is opened again once it is back; a
+    # DEVICE_RESET message is queued whenever a device is closed.
 
-    def __init__(self, device=None, *args, **kwargs):
-        self._device = device
+    def __init__(self, device=None, stats=None, recorder=None,
+                 queue_size=None, policy=None, max_age=None,
+                 *args, **kwargs):
+        self.stats = stats
+        self.recorder = recorder
         self._running = threading.Event()
-        self._queue = queue.Queue()
-        self.start_thread(device)
+        self._lock = threading.Lock()
+        self._thread = None
+        # (device, add) requests handled by the reader thread
+        self._pending = []
+        self._devices = []
+        # lost device -> [time of the next attempt, delay]
+        self._lost = {}
+        # device reopened -> its last delay, until it delivers data
+        self._backoff = {}
+        self._queue = MessageQueue(
+            queue_size, policy, max_age, self._wakeup)
+        # self-pipe written by the reader to wake up the consumer
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        # self-pipe written to wake up the reader
+        self._control_r, self._control_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w,
+                   self._control_r, self._control_w):
+            os.set_blocking(fd, False)
+        if device is not None:
+            self.add_device(device)
 
-    def start_thread(self, device=None):
-        if device is None:
-            if self._device is None:
-                return
-            device = self.device
-        else:
-            self._device = device
-        # TODO: Check if the device exists
+    def add_device(self, device):
+        self._request(device, True)
+
+    def remove_device(self, device):
+        self._request(device, False)
+
+    def devices(self):
+        return list(self._devices)
+
+    def lost_devices(self):
+        # devices waited for
+        return list(self._lost)
+
+    def _request(self, device, add):
+        with self._lock:
+            self._pending.append((device, add))
+            if self._running.is_set():
+                self._notify()
+            else:
+                self._start_thread()
+
+    def _notify(self):
         try:
-            self._thread = threading.Thread(
-                target=self._read_device,
-                args=(self._queue, device))
-            self._thread.setDaemon(True)
-            self._thread.start()
-        except Exception:
-            print("Exception!", sys.exc_info()[2])
+            os.write(self._control_w, b'\0')
+        except (BlockingIOError, OSError):
             pass
 
+    def _start_thread(self):
+        # called with the lock held; a previous reader still closing its
+        # devices notices it is not the current thread and leaves
+        self._running.set()
+        self._queue.open()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
     def stop_thread(self):
         logging.info('Stop midi-thread request')
-        if self._running.is_set():
+        with self._lock:
+            if not self._running.is_set():
+                return
             logging.debug('setting running flag off...')
             self._running.clear()
-            logging.debug('closing pipe...')
-            self._device_pipe.kill()
-            self._device_pipe.stdout.close()
-            self._thread.join(1)
-            logging.debug('Midi-thread closed')
-
-    def _read_device(self, queue, device):
-        self._device_pipe = subprocess.Popen(
-            ['cat', device],
-            stdout=subprocess.PIPE, bufsize=0)
-        message = []
-        expected_length = -1
-        self._running.set()
-        data = None
-        # cmd  meaning        #par param 1    param 2
-        # ----+--------------+----+----------+-------
-        # 0x80 Note-off       2    key        velocity
-        # 0x90 Note-on        2    key        velocity
-        # 0xA0 Aftertouch     2    key        touch
-        # 0xB0 Continuous
-        #      Controller     2    controller value
-        # 0xC0 Patch change   2    instrument
-        # 0xD0 Channel
-        #      Pressure       1    pressure
-        # 0xE0 Pitch bend     2    lsb(7bits) msb(7bits)
-        # 0xF0 (non-musical commands)
-        with self._device_pipe.stdout as f:
-            while self._running.is_set():
-                try:
-                    data = ord(f.read(1))
-                    if data is not None and data >= 0x80:
-                        # status message
-                        message = []
-                        if data < 0xC0:
-                            expected_length = 3
-                        else:
-                            expected_length = -1
-                except Exception:
-                    if data is not None:
-                        logging.error(
-                            "Midi message not understood: %s - %s",
-                            hex(data), message)
+            self._notify()
+            self._queue.close()
+        self._thread.join(1)
+        logging.debug('Midi-thread closed')
+
+    def _open_device(self, selector, devices, device, log=logging.error):
+        # True when `device` is read
+        if device in devices:
+            return True
+        try:
+            fd = os.open(device, os.O_RDONLY | os.O_NONBLOCK)
+            # files and FIFOs end, device nodes come back
+            supervised = stat.S_ISCHR(os.fstat(fd).st_mode)
+        except OSError as e:
+            log("Cannot open %s: %s", device, e)
+            return False
+        selector.register(fd, selectors.EVENT_READ,
+                          (device, MidiParser(source=device), supervised))
+        devices.append(device)
+        logging.info("Reading %s", device)
+        return True
+
+    def _close_device(self, selector, devices, device):
+        for key in list(selector.get_map().values()):
+            if key.data is not None and key.data[0] == device:
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                # release the keys held on the device
+                self._queue.put(MidiMessage(
+                    DEVICE_RESET, 0, 0, time.monotonic(), device))
+                self._wakeup()
+        if device in devices:
+            devices.remove(device)
+
+    def _reconnect(self, selector, devices, lost):
+        # open the lost devices due, less and less often; returns the
+        # seconds until the next attempt, None if no device is lost
+        now = time.monotonic()
+        for device in list(lost):
+            entry = lost[device]
+            if entry[0] > now:
+                continue
+            if self._open_device(selector, devices, device, logging.debug):
+                logging.info("%s reconnected", device)
+                self._backoff[device] = entry[1]
+                del lost[device]
+            else:
+                entry[1] = min(2 * entry[1], RECONNECT_MAX_DELAY)
+                entry[0] = now + entry[1]
+        if not lost:
+            return None
+        return max(0, min(entry[0] for entry in lost.values()) - now)
+
+    def _run(self):
+        current = threading.current_thread()
+        devices = self._devices = []
+        lost = self._lost = {}
+        backoff = self._backoff = {}
+        selector = selectors.DefaultSelector()
+        selector.register(self._control_r, selectors.EVENT_READ, None)
+        buf = bytearray(READ_BUFFER_SIZE)
+        put = self._queue.put
+        monotonic = time.monotonic
+        stats = self.stats
+        recorder = self.recorder
+        try:
+            while True:
+                with self._lock:
+                    if (not self._running.is_set() or
+                            self._thread is not current):
+                        break
+                    pending = self._pending
+                    self._pending = []
+                for (device, add) in pending:
+                    lost.pop(device, None)
+                    backoff.pop(device, None)
+                    if add:
+                        self._open_device(selector, devices, device)
                     else:
-                        logging.error("Midi message was NONE")
-                    expected_length = -1
-                    data = None
+                        self._close_device(selector, devices, device)
+                timeout = None
+                if lost:
+                    timeout = self._reconnect(selector, devices, lost)
+                if not devices and not lost:
+                    with self._lock:
+                        if not self._pending:
+                            # last device gone
+                            if self._thread is current:
+                                self._running.clear()
+                            break
+                    continue
+                for (key, _) in selector.select(timeout):
+                    if key.data is None:
+                        drain_pipe(self._control_r)
+                        continue
+                    (device, parser, supervised) = key.data
+                    try:
+                        length = os.readv(key.fd, [buf])
+                        now = monotonic()
+                    except BlockingIOError:
+                        continue
+                    except OSError as e:
+                        logging.error("Cannot read %s: %s", device, e)
+                        length = 0
+                    if not length:
+                        logging.info("End of stream on %s", device)
+                        self._close_device(selector, devices, device)
+                        if supervised:
+                            logging.warning("Waiting for %s", device)
+                            # reopened, but no data since: back off more
+                            delay = backoff.pop(device, None)
+                            delay = RECONNECT_DELAY if delay is None else min(
+                                2 * delay, RECONNECT_MAX_DELAY)
+                            lost[device] = [monotonic() + delay, delay]
+                        continue
+                    if backoff:
+                        backoff.pop(device, None)
+                    if recorder is not None:
+                        recorder.write(now, buf[:length], device)
+                    # parse the whole chunk before reading again
+                    for message in parser.feed(buf, length, now):
+                        put(message)
+                    if stats is not None:
+                        stats.add('parse', monotonic() - now)
+                    self._wakeup()
+        finally:
+            for device in list(devices):
+                self._close_device(selector, devices, device)
+            lost.clear()
+            backoff.clear()
+            selector.close()
+            with self._lock:
+                if self._thread is current:
+                    self._running.clear()
+            self._wakeup()
 
-                if expected_length:
-                    message.append(data)
-                    if len(message) >= expected_length:
-                        queue.put(message)
-                        expected_length = -1
+    def _wakeup(self):
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except (BlockingIOError, OSError):
+            # the pipe is full: the consumer is already notified
+            pass
+
+    def fileno(self):
+        return self._wakeup_r
 
     def read(self):
-        try:
-            return self._queue.get(False)
-        except Exception:
-            return False
+        # Drain the wakeup pipe before the queue so no wakeup is lost
+        drain_pipe(self._wakeup_r)
+        return self._queue.read()
+
+    def counters(self):
+        return self._queue.counters()
+
+    def close(self):
+        self.stop_thread()
+        for fd in (self._wakeup_r, self._wakeup_w,
+                   self._control_r, self._control_w):
+            os.close(fd)
+        if self.recorder is not None:
+            self.recorder.close()
 
     def is_running(self):
         return self._running.is_set()
 
-    def set_device(self, device=None):
-        if device is not None:
-            self._device = device
 
+class ReplayKeyboard(MidiKeyboard):
+    # Feeds a session saved by SessionRecorder instead of a device.
+    # speed: 1.0 for the original timing, 2.0 twice faster, 0 max speed
+    # The session is the only source: devices added or removed are ignored.
+
+    def __init__(self, file_name, speed=1.0, stats=None, *args, **kwargs):
+        self.speed = speed
+        MidiKeyboard.__init__(self, stats=stats)
+        self._request(file_name, True)
+
+    def add_device(self, device):
+        logging.warning("Replaying a session, %s not read", device)
+
+    def remove_device(self, device):
+        logging.warning("Replaying a session, %s not closed", device)
+
+    def _run(self):
+        with self._lock:
+            (file_name, _) = self._pending[0]
+            self._pending = []
+        try:
+            records = read_session(file_name)
+            next(records)
+        except (OSError, ValueError) as e:
+            logging.error("Cannot replay %s: %s", file_name, e)
+            self._running.clear()
+            self._wakeup()
+            return
+        # recorded device -> its parser, the messages keep their device
+        parsers = {}
+        put = self._queue.put
+        monotonic = time.monotonic
+        stats = self.stats
+        try:
+            start = monotonic()
+            offset = 0.0
+            for (delta, device, data) in records:
+                if not self._running.is_set():
+                    break
+                if self.speed:
+                    offset += delta / self.speed
+                    delay = start + offset - monotonic()
+                    while delay > 0 and self._running.is_set():
+                        # wait, unless stop_thread() wakes us up
+                        if select.select([self._control_r], [], [], delay)[0]:
+                            drain_pipe(self._control_r)
+                        delay = start + offset - monotonic()
+                parser = parsers.get(device)
+                if parser is None:
+                    parser = parsers[device] = MidiParser(source=device)
+                    self._devices = list(parsers)
+                now = monotonic()
+                for message in parser.feed(data, len(data), now):
+                    put(message)
+                if stats is not None:
+                    stats.add('parse', monotonic() - now)
+                self._wakeup()
+            logging.info("End of replay of %s", file_name)
+        finally:
+            # like the devices closed
+            for device in parsers:
+                put(MidiMessage(DEVICE_RESET, 0, 0, monotonic(), device))
+            self._devices = []
+            self._running.clear()
+            self._wakeup()
+
+
+# Session files: magic, then for each chunk read from a device the time
+# since the previous chunk in microseconds, the length, the index of the
+# device and the raw bytes. A chunk of index SESSION_DEVICE holds the name
+# of the next device, indexed from 0 in the order they are first read.
+SESSION_MAGIC = b'M2DTREC2'
+SESSION_CHUNK = struct.Struct('<IHB')
+SESSION_DEVICE = 0xFF
+
+
+class SessionRecorder(object):
+    # Saves the raw device stream; the reader thread only queues the chunks,
+    # a writer thread does the (buffered) file writes
+
+    def __init__(self, file_name):
+        self._file = open(file_name, 'wb')
+        self._file.write(SESSION_MAGIC)
+        self._queue = queue.Queue()
+        self._last = None
+        # device -> index
+        self._devices = {}
+        self._thread = threading.Thread(target=self._write_session)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, timestamp, data, device=''):
+        self._queue.put((timestamp, bytes(data), device))
+
+    def _write_session(self):
+        pack = SESSION_CHUNK.pack
+        devices = self._devices
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            (timestamp, data, device) = item
+            index = devices.get(device)
+            if index is None:
+                if len(devices) == SESSION_DEVICE:
+                    logging.debug('%s not recorded', device)
+                    continue
+                index = devices[device] = len(devices)
+                name = device.encode()
+                self._file.write(pack(0, len(name), SESSION_DEVICE))
+                self._file.write(name)
+            delta = 0 if self._last is None else timestamp - self._last
+            self._last = timestamp
+            self._file.write(pack(
+                min(int(delta * 1e6), 0xFFFFFFFF), len(data), index))
+            self._file.write(data)
+            if self._queue.empty():
+                self._file.flush()
+        self._file.close()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+
+def read_session(file_name):
+    # Generator: checks the file when first advanced, then yields
+    # (seconds since the previous chunk, device, raw bytes)
+    with open(file_name, 'rb') as f:
+        if f.read(len(SESSION_MAGIC)) != SESSION_MAGIC:
+            raise ValueError("not a midi2dt session: %s" % file_name)
+        yield None
+        devices = []
+        while True:
+            header = f.read(SESSION_CHUNK.size)
+            if len(header) < SESSION_CHUNK.size:
+                return
+            (delta, length, index) = SESSION_CHUNK.unpack(header)
+            data = f.read(length)
+            if index == SESSION_DEVICE:
+                devices.append(data.decode(errors='replace'))
+            elif index < len(devices):
+                yield (delta / 1e6, devices[index], data)
+
+
+def open_keyboard(device=None, stats=None):
+    # the MIDI source selected on the command line
+    if REPLAY_FILE:
+        return ReplayKeyboard(REPLAY_FILE, REPLAY_SPEED, stats=stats)
+    recorder = RECORD_FILE and SessionRecorder(RECORD_FILE) or None
+    return MidiKeyboard(device, stats=stats, recorder=recorder)
+
+
+class OutputBackend(object):
+    # Emits keystrokes. `send` takes a sequence of (event, value) where
+    # event is 'key', 'keydown' or 'keyup' and value a 'Mod+Key' string,
+    # 'click', 'mousedown' or 'mouseup' and value a button number, or
+    # 'mousemove' and 'scroll' and value (x, y) in pixels or steps.
+    # Events of a batch are emitted in order.
+
+    def send(self, events):
+        raise NotImplementedError
+
+    def counters(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class NullBackend(OutputBackend):
+
+    def __init__(self):
+        self.count = 0
+
+    def send(self, events):
+        self.count += len(events)
+
+
+class RecordingBackend(OutputBackend):
+
+    def __init__(self):
+        self.events = []
+
+    def send(self, events):
+        self.events.extend(events)
+
+
+class AsyncOutput(OutputBackend):
+    # Hands the batches over to a worker thread sending them with
+    # `backend`, so a slow output (fork of xdotool, X round trips) does not
+    # delay the reading of MIDI messages. A single worker sends the
+    # batches in order: a keyup is never sent before its keydown. Beyond
+    # `maxsize` events waiting, only the keyups of new batches are queued.
+
+    def __init__(self, backend, maxsize=OUTPUT_QUEUE_SIZE, stats=None):
+        self.backend = backend
+        self.maxsize = maxsize
+        self.stats = stats
+        self.dropped = 0
+        self.max_depth = 0
+        # [(time queued, events)], and count of events not sent yet
+        self._pending = []
+        self._depth = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, events):
+        queued = time.monotonic()
+        with self._cond:
+            if self._depth + len(events) > self.maxsize:
+                kept = [event for event in events
+                        if event[0] in RELEASE_EVENTS]
+                self.dropped += len(events) - len(kept)
+                events = kept
+                if not events:
+                    return
+            self._pending.append((queued, events))
+            self._depth += len(events)
+            if self._depth > self.max_depth:
+                self.max_depth = self._depth
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                (batches, self._pending) = (self._pending, [])
+            # all the batches waiting in one call
+            events = [event for (_, batch) in batches for event in batch]
+            try:
+                self.backend.send(events)
+            except Exception:
+                logging.exception("Keystrokes not sent")
+            with self._cond:
+                self._depth -= len(events)
+            if self.stats is not None:
+                sent = time.monotonic()
+                for (queued, _) in batches:
+                    self.stats.add('output', sent - queued)
+
+    def counters(self):
+        return {
+            'output queued': self._depth,
+            'output max queued': self.max_depth,
+            'output dropped': self.dropped,
+        }
+
+    def close(self):
+        # the events queued are sent first
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self.backend.close()
+
+
+class CommandRunner(object):
+    # Runs the shell commands of the bindings in `workers` threads started
+    # beforehand, so a slow command never delays the MIDI messages. A
+    # command is killed after its timeout, and dropped while `concurrency`
+    # runs of it are not done or `maxsize` commands are waiting.
+
+    def __init__(self, workers=COMMAND_WORKERS, maxsize=COMMAND_QUEUE_SIZE):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.done = 0
+        self.dropped = 0
+        self.timed_out = 0
+        # command -> its runs waiting or running
+        self._runs = {}
+        self._pending = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._run, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def run(self, command):
+        # command: (shell command, timeout, concurrency)
+        (line, _, concurrency) = command
+        with self._cond:
+            runs = self._runs.get(line, 0)
+            if runs >= concurrency or len(self._pending) >= self.maxsize:
+                self.dropped += 1
+                return
+            self._runs[line] = runs + 1
+            self._pending.append(command)
+            self._cond.notify()
+        self.start()
+
+    def _run(self):
+        # imported by the threads before the first command
+        import subprocess
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                (line, timeout, _) = self._pending.popleft()
+            timed_out = False
+            try:
+                # in its own process group, killed with its children
+                process = subprocess.Popen(
+                    line, shell=True, stdin=subprocess.DEVNULL,
+                    start_new_session=True)
+                try:
+                    process.wait(timeout)
+                except subprocess.TimeoutExpired:
+                    logging.warning("Command killed after %gs: %s",
+                                    timeout, line)
+                    timed_out = True
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+            except Exception:
+                logging.exception("Command failed: %s", line)
+            with self._cond:
+                self.done += 1
+                self.timed_out += timed_out
+                self._runs[line] -= 1
+                if not self._runs[line]:
+                    del self._runs[line]
+
+    def counters(self):
+        return {
+            'commands run': self.done,
+            'commands dropped': self.dropped,
+            'commands timed out': self.timed_out,
+        }
+
+    def close(self):
+        # the commands running are not waited for
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class XdotoolBackend(OutputBackend):
+    # `xdotool -` only runs its script once stdin is closed, so commands
+    # can not be streamed to a long-lived process: a batch is chained on
+    # the command line of a single xdotool call instead. The call is waited
+    # for (on the output worker), so batches are delivered in order.
+
+    # scroll up, down, left, right
+    SCROLL_BUTTONS = ('4', '5', '6', '7')
+
+    def send(self, events):
+        if not events:
+            return
+        args = ["xdotool"]
+        for event, value in events:
+            if event == 'mousemove':
+                args.extend(('mousemove_relative', '--') +
+                            tuple(map(str, value)))
+            elif event == 'scroll':
+                for (steps, buttons) in ((value[1], self.SCROLL_BUTTONS[:2]),
+                                         (value[0], self.SCROLL_BUTTONS[2:])):
+                    if steps:
+                        args.extend(('click', '--delay', '0', '--repeat',
+                                     str(abs(steps)), buttons[steps > 0]))
+            else:
+                args.append(event)
+                args.append(str(value))
+        # imported with the first keystroke, not at startup
+        import subprocess
+        try:
+            process = subprocess.Popen(args)
+        except OSError as e:
+            logging.error("Cannot run xdotool: %s", e)
+            return
+        try:
+            status = process.wait(XDOTOOL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            logging.warning("xdotool killed after %gs", XDOTOOL_TIMEOUT)
+            process.kill()
+            process.wait()
+            return
+        if status:
+            logging.error("xdotool failed (%d): %s", status, ' '.join(args))
+
+
+class XTestBackend(OutputBackend):
+    # Fake key events through the XTest extension, without any process
+
+    MODIFIERS = {
+        'Ctrl': 'Control_L',
+        'Alt': 'Alt_L',
+        'Shift': 'Shift_L',
+        'Super': 'Super_L',
+    }
+
+    def __init__(self, display=None):
+        import_ctypes()
+        self._x11 = ctypes.cdll.LoadLibrary(
+            ctypes.util.find_library('X11') or 'libX11.so.6')
+        self._xtst = ctypes.cdll.LoadLibrary(
+            ctypes.util.find_library('Xtst') or 'libXtst.so.6')
+        self._x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self._x11.XOpenDisplay.restype = ctypes.c_void_p
+        self._x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self._x11.XFlush.argtypes = [ctypes.c_void_p]
+        self._x11.XStringToKeysym.argtypes = [ctypes.c_char_p]
+        self._x11.XStringToKeysym.restype = ctypes.c_ulong
+        self._x11.XKeysymToKeycode.argtypes = [
+            ctypes.c_void_p, ctypes.c_ulong]
+        self._x11.XKeysymToKeycode.restype = ctypes.c_ubyte
+        self._xtst.XTestFakeKeyEvent.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+        self._xtst.XTestFakeButtonEvent.argtypes = [
+            ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+        self._xtst.XTestFakeRelativeMotionEvent.argtypes = [
+            ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_ulong]
+        self._display = self._x11.XOpenDisplay(
+            display and display.encode() or None)
+        if not self._display:
+            raise OSError("Cannot open X display")
+        self._keycodes = {}
+
+    def keycodes(self, value):
+        # 'Ctrl+Shift+Q' -> keycodes to press in order, cached
+        try:
+            return self._keycodes[value]
+        except KeyError:
+            pass
+        codes = []
+        for name in value.split('+'):
+            if not name:
+                continue
+            keysym = self._x11.XStringToKeysym(
+                self.MODIFIERS.get(name, name).encode())
+            code = keysym and self._x11.XKeysymToKeycode(
+                self._display, keysym)
+            if not code:
+                logging.error("No keycode for %s in %s", name, value)
+                continue
+            codes.append(code)
+        codes = tuple(codes)
+        self._keycodes[value] = codes
+        return codes
+
+    def send(self, events):
+        fake = self._xtst.XTestFakeKeyEvent
+        button = self._xtst.XTestFakeButtonEvent
+        display = self._display
+        for event, value in events:
+            if event == 'mousemove':
+                self._xtst.XTestFakeRelativeMotionEvent(
+                    display, value[0], value[1], 0)
+                continue
+            if event == 'scroll':
+                # buttons 4 to 7, as XdotoolBackend.SCROLL_BUTTONS
+                for (steps, up) in ((value[1], 4), (value[0], 6)):
+                    for _ in range(abs(steps)):
+                        button(display, up + (steps > 0), True, 0)
+                        button(display, up + (steps > 0), False, 0)
+                continue
+            if event in ('click', 'mousedown', 'mouseup'):
+                if event != 'mouseup':
+                    button(display, value, True, 0)
+                if event != 'mousedown':
+                    button(display, value, False, 0)
+                continue
+            codes = self.keycodes(value)
+            if event != 'keyup':
+                for code in codes:
+                    fake(display, code, True, 0)
+            if event != 'keydown':
+                for code in reversed(codes):
+                    fake(display, code, False, 0)
+        self._x11.XFlush(display)
+
+    def close(self):
+        if self._display:
+            self._x11.XCloseDisplay(self._display)
+            self._display = None
+
+
+OUTPUT_BACKENDS = {
+    'xdotool': XdotoolBackend,
+    'xtest': XTestBackend,
+    'null': NullBackend,
+    'record': RecordingBackend,
+}
+
+
+# sent from the caller thread (tests and benchmarks)
+SYNC_OUTPUT_BACKENDS = ('null', 'record')
+
+
+def make_output_backend(name=None, stats=None):
+    name = name or OUTPUT_BACKEND
+    backend = OUTPUT_BACKENDS[name]()
+    if name in SYNC_OUTPUT_BACKENDS:
+        return backend
+    return AsyncOutput(backend, stats=stats)
+
+
+def format_keystroke(modifier, value):
+    if not value or value == UNDEFINED_KEY:
+        return None
+    if modifier and len(modifier) > 1:
+        return "{}{}".format(modifier, value)
+    # keys saved as numbers
+    return str(value)
+
+
+def parse_key_type(key_type):
+    # 'Abs' column: saved as 0/1, True/False or their string forms
+    return 1 if key_type in (1, True, '1', 'True') else 0
+
+
+def load_layouts(file_name=DEFAULT_CONFIG_FILE):
+    # (layer, device) -> {midikey -> [type, key id, modifier, key, abs,
+    # options]}; entries without "layer" are in the base layer (''), and
+    # without "device" shared by all devices ('')
+    with open(file_name, "r") as f:
+        options = json.load(f)
+    layouts = {('', ''): {}}
+    for line in options:
+        values = list(line["values"])
+        if len(values) < 5:
+            # configs saved without the 'Abs' column
+            values.append(0)
+        bindings = layouts.setdefault(
+            (line.get("layer", ''), line.get("device", '')), {})
+        bindings[int(line['tags'][0], 16)] = values[:5] + [dict(
+            (name, line[name]) for name in BINDING_OPTIONS if name in line)]
+    return layouts
+
+
+def load_bindings(file_name=DEFAULT_CONFIG_FILE, device='', layer=''):
+    return load_layouts(file_name).get((layer, device), {})
+
+
+def parse_macro(value, retrigger=None):
+    # 'macro:Ctrl+c 100ms Ctrl+v' -> (segments, queue): segments of
+    # (delay before, events), a delay ends a segment
+    segments = []
+    (delay, events) = (0.0, [])
+    for step in value[len(MACRO_PREFIX):].split():
+        if step.endswith('ms') and step[:-2].replace('.', '', 1).isdigit():
+            if events:
+                segments.append((delay, tuple(events)))
+                (delay, events) = (0.0, [])
+            delay += float(step[:-2]) / 1000
+        elif step.startswith(('keydown:', 'keyup:')):
+            events.append(tuple(step.split(':', 1)))
+        else:
+            events.append(('key', step))
+    if events or delay:
+        # a last delay spaces the queued runs
+        segments.append((delay, tuple(events)))
+    return (tuple(segments), retrigger == 'queue')
+
+
+def parse_mouse(value):
+    # 'mouse:x 2.5' -> (axis index in MOUSE_AXES, amount), 'mouse:button
+    # 1' -> (None, button)
+    (name, _, amount) = value[len(MOUSE_PREFIX):].strip().partition(' ')
+    if name == 'button':
+        return (None, int(amount or 1))
+    if name not in MOUSE_AXES:
+        raise ValueError('unknown mouse action: %r' % value)
+    return (MOUSE_AXES.index(name), float(amount or 1))
+
+
+def chord_notes(midikey):
+    # notes of a chord key, in ascending order
+    return [note for note in range(128) if midikey >> note & 1]
+
+
+def binding_code(midikey):
+    # code of the MIDI key of a binding: relative CC bindings are stored
+    # as (code << 1) | direction
+    if midikey >= CHORD_KEY:
+        return midikey
+    code = midikey & 0xFFFF
+    if (code >> 9) == 0xB:
+        code >>= 1
+    return midikey & ~0xFFFF | code
+
+
+def zone_bounds(zones):
+    # lowest value of each zone: `zones` equal zones (value * zones // 128),
+    # or the lowest value of each zone but the first
+    if isinstance(zones, int):
+        if zones < 1:
+            raise ValueError('at least one zone: %r' % zones)
+        return [-(-128 * i // zones) for i in range(zones)]
+    return [0] + sorted(int(value) for value in zones)
+
+
+# default zones of the absolute controllers, round(value * 9 / 127): the
+# first and the last ones are half as wide as the others
+CC_ZONE_BOUNDS = [0] + [
+    value for value in range(1, 128)
+    if round(value * (CC_ZONE_COUNT - 1) / 127) !=
+    round((value - 1) * (CC_ZONE_COUNT - 1) / 127)]
+
+
+def zone_table(bounds, codes, hysteresis=0):
+    # [last zone << 7 | value] -> zone, where bounds[i] is the lowest value
+    # of the zone codes[i]: the row of the zone of the previous message
+    # keeps it within `hysteresis` of its bounds, row 0 has no previous
+    # zone (the one of the lowest zone when coded 0)
+    if len(bounds) > 15:
+        raise ValueError('at most 15 zones: %r' % (bounds[1:],))
+    row = bytearray(128)
+    for (low, code) in zip(bounds, codes):
+        row[low:] = bytes((code,)) * (128 - low)
+    table = bytearray(row * 16)
+    if hysteresis:
+        for (i, code) in enumerate(codes[:len(bounds)]):
+            if not code:
+                # row 0 is for no previous zone
+                continue
+            low = max(0, bounds[i] - hysteresis)
+            high = 128 if i + 1 == len(bounds) else min(
+                128, bounds[i + 1] + hysteresis)
+            table[code << 7 | low:code << 7 | high] = (
+                bytes((code,)) * (high - low))
+    return bytes(table)
+
+
+# codes of the velocity layers: 0 (normal), then 2 (middle), 3 (strong)...
+VELOCITY_CODES = (0,) + tuple(range(NOTE_PRESSURE_MIDDLE_DELTA, 16))
+# and of the absolute CC zones: 1..15
+CC_ZONE_CODES = tuple(range(1, 16))
+
+
+def compile_zones(key, zones=None, hysteresis=0):
+    # zone table of the note (0x9nn) or controller (0xBnn) `key`; the
+    # velocity of a note does not depend on the previous one: no hysteresis
+    if key >> 8 == 0x9:
+        if zones is None:
+            zones = (NOTE_PRESSURE_MIDDLE + 1, NOTE_PRESSURE_STRONG + 1)
+        return zone_table(zone_bounds(zones), VELOCITY_CODES)
+    return zone_table(
+        CC_ZONE_BOUNDS if zones is None else zone_bounds(zones),
+        CC_ZONE_CODES, hysteresis)
+
+
+VELOCITY_ZONES = compile_zones(0x900)
+CC_ZONES = compile_zones(0xB00)
+
+
+def channel_key(key, channel):
+    # binding of `key` for the MIDI channel `channel` (0..15) only
+    return key | (channel + 1) << CHANNEL_SHIFT
+
+
+class KeyMap(object):
+    # Flat lookup tables compiled from the bindings and indexed by the
+    # encoded key (0x900|note, CC << 1 | direction, pressure << 12, ...).
+    # values: keystroke ready to send ('Mod+Key') or None
+    # types: state of the binding (column 'Abs')
+    # channels: (values, types) of each MIDI channel, the tables above
+    # unless the channel has bindings of its own
+
+    # rates: key -> (min interval between keys, accumulate), for the
+    # bindings with a "rate" option
+    # zones: key id (0x9nn, 0xBnn) -> zone table of its velocity layers or
+    # absolute CC zones, from the "zones" and "hysteresis" options
+
+    # chords: notes bitset -> (keystroke, state), chord_notes: bitset of
+    # the notes of all chords, chord_prefixes: bitsets of notes that can
+    # still become a chord when more notes are pressed
+
+    # switches: key (chord key for the chords) -> layer, for the
+    # 'layer:name' bindings
+    # actions: value -> (kind, data) of the bindings other than keys,
+    # ('macro', parse_macro()), ('command', (command, timeout,
+    # concurrency)) or ('mouse', parse_mouse())
+
+    def __init__(self, bindings=None, tables=None):
+        if tables is not None:
+            # as saved in the config cache (bytearrays come back as bytes,
+            # the tables are only read)
+            self.__dict__.update(tables)
+            return
+        self.values = [None] * KEYMAP_SIZE
+        self.types = bytearray(KEYMAP_SIZE)
+        self.channels = [(self.values, self.types)] * 16
+        self.rates = {}
+        self.zones = [None] * 0x1000
+        self.zones[0x900:0x980] = [VELOCITY_ZONES] * 128
+        self.zones[0xB00:0xB80] = [CC_ZONES] * 128
+        self.chords = {}
+        self.chord_notes = 0
+        self.chord_prefixes = set()
+        self.switches = {}
+        self.actions = {}
+        if bindings:
+            # the tables of a channel start as a copy of the ones of all
+            # channels: set the bindings of single channels last
+            for key in sorted(bindings):
+                self.set(key, bindings[key])
+
+    def set(self, key, row):
+        (typ, key_note, mod, val, key_type) = row[:5]
+        options = len(row) > 5 and row[5] or {}
+        if key >= CHORD_KEY:
+            self.set_chord(key ^ CHORD_KEY, format_keystroke(mod, val),
+                           parse_key_type(key_type), options)
+            return
+        value = format_keystroke(mod, val)
+        (values, types) = (self.values, self.types)
+        channel = key >> CHANNEL_SHIFT
+        if channel:
+            if value is None:
+                # the binding of all channels applies
+                return
+            key &= KEYMAP_SIZE - 1
+            (values, types) = self.channel_tables(channel - 1)
+        values[key] = value
+        types[key] = parse_key_type(key_type)
+        if value and value.startswith(LAYER_PREFIX):
+            # switches and rates apply to all channels
+            self.switches[key] = value[len(LAYER_PREFIX):]
+            values[key] = None
+        elif value:
+            self.set_action(value, options)
+        if options.get('rate'):
+            self.rates[key] = (
+                1.0 / float(options['rate']),
+                options.get('overflow') == 'accumulate')
+        if (options.get('zones') or options.get('hysteresis')) and (
+                (key >> 8 & 0xF) in (0x9, 0xB)):
+            self.zones[key & 0xFFF] = compile_zones(
+                key & 0xFFF, options.get('zones'),
+                int(options.get('hysteresis', 0)))
+
+    def channel_tables(self, channel):
+        tables = self.channels[channel]
+        if tables[0] is self.values:
+            tables = self.channels[channel] = (
+                list(self.values), bytearray(self.types))
+        return tables
+
+    def set_action(self, value, options):
+        # the macro, command and mouse bindings
+        if value.startswith(MACRO_PREFIX):
+            self.actions[value] = (
+                'macro', parse_macro(value, options.get('retrigger')))
+        elif value.startswith(COMMAND_PREFIX):
+            self.actions[value] = ('command', (
+                value[len(COMMAND_PREFIX):].strip(),
+                float(options.get('timeout', COMMAND_TIMEOUT)),
+                int(options.get('concurrency', 1))))
+        elif value.startswith(MOUSE_PREFIX):
+            self.actions[value] = ('mouse', parse_mouse(value))
+
+    def set_chord(self, notes, value, key_type, options=None):
+        if value is None or bin(notes).count('1') < 2:
+            return
+        self.chords[notes] = (value, key_type)
+        if value.startswith(LAYER_PREFIX):
+            # the switches of the chords are keyed by their chord key
+            self.switches[CHORD_KEY | notes] = value[len(LAYER_PREFIX):]
+        else:
+            self.set_action(value, options or {})
+        self.chord_notes |= notes
+        # every subset of the notes leads to this chord
+        sub = (notes - 1) & notes
+        while sub:
+            self.chord_prefixes.add(sub)
+            sub = (sub - 1) & notes
+
+
+def compile_layouts(layouts):
+    # (layer, device) -> KeyMap; the bindings of the base layer for all
+    # devices are overridden by the ones of the device, of the layer, then
+    # of the layer for the device
+    keymaps = {}
+    for layer in set(layer for (layer, _) in layouts) | set(('',)):
+        devices = set(device for (name, device) in layouts
+                      if name in ('', layer)) | set(('',))
+        for device in devices:
+            merged = {}
+            for key in (('', ''), ('', device), (layer, ''), (layer, device)):
+                merged.update(layouts.get(key, {}))
+            keymaps[(layer, device)] = KeyMap(merged)
+    return keymaps
+
+
+def config_stamp(file_name):
+    # the marshal format may change with the Python version
+    st = os.stat(file_name)
+    return (CONFIG_CACHE_VERSION, marshal.version, sys.hexversion,
+            st.st_mtime_ns, st.st_size)
+
+
+def load_config(file_name=DEFAULT_CONFIG_FILE):
+    # (layouts, keymaps) from the cache when it matches the file, else
+    # parsed and compiled, and cached for the next start
+    stamp = config_stamp(file_name)
+    cache_file = file_name + CONFIG_CACHE_SUFFIX
+    try:
+        # marshal, unlike pickle, only builds plain values, but it is not
+        # meant for untrusted data: the cache is as trusted as its directory
+        # read at once: marshal.load() reads the file value by value
+        with open(cache_file, 'rb') as f:
+            (cache_stamp, layouts, tables) = marshal.loads(f.read())
+            if cache_stamp == stamp:
+                return (layouts, dict(
+                    (device, KeyMap(tables=keymap_tables))
+                    for device, keymap_tables in tables.items()))
+    except Exception:
+        # missing, outdated or broken cache
+        pass
+    layouts = load_layouts(file_name)
+    keymaps = compile_layouts(layouts)
+    try:
+        # plain tables: readable whatever the name of this module
+        tables = dict(
+            (device, keymap.__dict__) for device, keymap in keymaps.items())
+        tmp_file = cache_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(marshal.dumps((stamp, layouts, tables)))
+        os.replace(tmp_file, cache_file)
+    except (OSError, ValueError) as e:
+        logging.debug('Config cache not saved: %s', e)
+    return (layouts, keymaps)
+
+
+class ConfigWatcher(object):
+    # Reloads the configuration file when it changes on disk. The new
+    # (layouts, keymaps) are loaded by the watcher thread and handed over
+    # with read(), fileno() becomes readable when one is ready.
+
+    def __init__(self, file_name=DEFAULT_CONFIG_FILE,
+                 interval=CONFIG_POLL_INTERVAL):
+        self.file_name = file_name
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        (self._wakeup_r, self._wakeup_w) = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self.reset()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset(self):
+        # the file as it is now is loaded (e.g. just saved)
+        try:
+            self._stamp = config_stamp(self.file_name)
+        except OSError:
+            self._stamp = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                stamp = config_stamp(self.file_name)
+                if stamp == self._stamp:
+                    continue
+                self._stamp = stamp
+                config = load_config(self.file_name)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                # missing, or being written: retried at the next change
+                logging.debug('Config not reloaded: %s', e)
+                continue
+            logging.info('%s changed, reloaded', self.file_name)
+            self._queue.put(config)
+            os.write(self._wakeup_w, b'\0')
+
+    def fileno(self):
+        return self._wakeup_r
+
+    def read(self):
+        # latest configuration loaded, or None
+        try:
+            os.read(self._wakeup_r, READ_BUFFER_SIZE)
+        except BlockingIOError:
+            pass
+        config = None
+        while not self._queue.empty():
+            config = self._queue.get_nowait()
+        return config
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
+class WindowFollower(object):
+    # Calls `callback` with the class of the active X window each time it
+    # changes ('' if unknown), polled from its own thread with xdotool, or
+    # xprop when xdotool is too old to know getwindowclassname (2021)
+
+    def __init__(self, callback, interval=WINDOW_POLL_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self._xprop = False
+        self._warned = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        current = None
+        while not self._stop.wait(self.interval):
+            window_class = self.window_class()
+            if window_class != current:
+                current = window_class
+                logging.debug('Active window: %s', window_class)
+                self.callback(window_class)
+
+    def window_class(self):
+        import subprocess
+        if not self._xprop:
+            try:
+                return subprocess.check_output(
+                    ['xdotool', 'getactivewindow', 'getwindowclassname'],
+                    stderr=subprocess.DEVNULL).decode().strip()
+            except (OSError, subprocess.CalledProcessError):
+                # no X display, no active window or an old xdotool
+                pass
+        try:
+            window = subprocess.check_output(
+                ['xprop', '-root', '_NET_ACTIVE_WINDOW'],
+                stderr=subprocess.DEVNULL).decode().split()[-1]
+            if window == '0x0':
+                # no active window
+                return ''
+            # WM_CLASS(STRING) = "instance", "Class"
+            names = subprocess.check_output(
+                ['xprop', '-id', window, 'WM_CLASS'],
+                stderr=subprocess.DEVNULL).decode().split('"')
+        except (OSError, IndexError, subprocess.CalledProcessError):
+            if not self._warned:
+                self._warned = True
+                logging.warning(
+                    'Class of the active window unknown: xdotool (2021 or '
+                    'later) or xprop needed, and an X display')
+            return ''
+        if not self._xprop:
+            self._xprop = True
+            logging.info('Active window found with xprop')
+        return len(names) > 3 and names[3] or ''
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class KeyState(object):
+    # State of the keys of a device, indexed by channel << 7 | note (or
+    # controller), allocated once
+
+    def __init__(self):
+        # last value of the controllers (relative mode)
+        self.cc_values = array('B', [NO_VALUE]) * STATE_SIZE
+        # last direction of the relative controllers of state 1: 0 down,
+        # 1 up
+        self.cc_directions = array('B', [NO_VALUE]) * STATE_SIZE
+        # key pressed by the notes, and by the absolute controllers of
+        # state 1, 0 if none; lists: an array would box the keys (> 255)
+        # again on each read
+        self.note_keys = [0] * STATE_SIZE
+        self.cc_keys = [0] * STATE_SIZE
+        # zone of the absolute controllers, 0 if none
+        self.cc_zones = array('B', [0]) * STATE_SIZE
+
+
+class ChordState(object):
+    # Chord recognition state of a device
+
+    def __init__(self):
+        # notes held back until the chord is known, and their messages
+        self.held = 0
+        self.pending = []
+        # end of the recognition window, None when no note is held back
+        self.deadline = None
+        # notes of the pressed chords -> their chord key, whose release is
+        # in Engine._down, None once released (remaining note-off are
+        # ignored)
+        self.active = {}
+
+
+class MacroPlayer(object):
+    # Plays the macros: the events up to the first delay are sent at once,
+    # in the batch of the MIDI message, the next ones when their delay has
+    # elapsed. A macro hit again while it plays is restarted (the keys it
+    # holds are released first) or, with the 'queue' policy, played again
+    # once done.
+
+    def __init__(self):
+        # value -> [deadline, segments, next segment, keys held, queued]
+        self._playing = {}
+
+    def __len__(self):
+        return len(self._playing)
+
+    def play(self, value, macro, now, events):
+        (segments, queue) = macro
+        if not segments:
+            return
+        entry = self._playing.get(value)
+        if entry is not None:
+            if queue:
+                entry[4] += 1
+                return
+            self.release(entry, events)
+        entry = [now + segments[0][0], segments, 0, [], 0]
+        if entry[0] > now or self.advance(entry, now, events):
+            self._playing[value] = entry
+        else:
+            self._playing.pop(value, None)
+
+    def advance(self, entry, now, events):
+        # send the segments due, False once the macro is done
+        segments = entry[1]
+        while entry[0] <= now:
+            held = entry[3]
+            for event in segments[entry[2]][1]:
+                events.append(event)
+                if event[0] == 'keydown':
+                    held.append(event[1])
+                elif event[0] == 'keyup' and event[1] in held:
+                    held.remove(event[1])
+            entry[2] += 1
+            if entry[2] == len(segments):
+                if not entry[4]:
+                    return False
+                entry[4] -= 1
+                entry[2] = 0
+            entry[0] += segments[entry[2]][0]
+        return True
+
+    def release(self, entry, events):
+        for value in entry[3]:
+            events.append(('keyup', value))
+        del entry[3][:]
+
+    def next_deadline(self):
+        if not self._playing:
+            return None
+        return min(entry[0] for entry in self._playing.values())
+
+    def flush(self, events, now):
+        for value in list(self._playing):
+            entry = self._playing[value]
+            if entry[0] <= now and not self.advance(entry, now, events):
+                del self._playing[value]
+
+    def cancel(self, events):
+        # stop all the macros, and release their keys
+        for entry in self._playing.values():
+            self.release(entry, events)
+        self._playing.clear()
+
+
+class MouseMotion(object):
+    # Adds up the mouse moves and scrolls of the bindings, sent at most
+    # `rate` times per second as whole pixels and scroll steps: the
+    # fractions are kept for the next frames
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / (MOUSE_RATE if rate is None else rate)
+        # time of the next frame, None when nothing is to send
+        self.deadline = None
+        self._last = float('-inf')
+        # along MOUSE_AXES
+        self._deltas = [0.0] * len(MOUSE_AXES)
+
+    def add(self, axis, amount, now):
+        self._deltas[axis] += amount
+        if self.deadline is None:
+            self.deadline = max(now, self._last + self.interval)
+
+    def flush(self, events, now):
+        if self.deadline is None or self.deadline > now:
+            return
+        self.deadline = None
+        self._last = now
+        deltas = self._deltas
+        # rounded first: 0.4 * 5 is a whole pixel
+        (x, y, scroll, hscroll) = whole = [
+            int(round(delta, 6)) for delta in deltas]
+        for axis in range(len(deltas)):
+            deltas[axis] -= whole[axis]
+        if x or y:
+            events.append(('mousemove', (x, y)))
+        if scroll or hscroll:
+            events.append(('scroll', (hscroll, scroll)))
+
+
+class CCCoalescer(object):
+    # Merges the keys of successive CC messages of a controller arriving
+    # within `window` seconds (0: within a batch): a relative controller
+    # gives a net count of repeated keys, an absolute one its last zone.
+    # Bindings with a rate emit at most one key per interval, the extra
+    # keys are dropped or accumulated for the next intervals.
+
+    def __init__(self, window=0.0):
+        self.window = window
+        self.merged = 0
+        self.dropped = 0
+        # controller -> [deadline, net count, key value, rate]
+        # (relative: [.., net, value if net > 0, value if net < 0, rate])
+        self._pending = {}
+        # key value -> time of the last key sent, for rate limited keys
+        self._last = {}
+
+    def add(self, controller, sign, value, rate, now):
+        entry = self._pending.get(controller)
+        if entry is None:
+            entry = self._pending[controller] = [
+                now + self.window, 0, None, None, rate]
+        else:
+            self.merged += 1
+        if sign:
+            entry[1] += sign
+            entry[sign > 0 and 2 or 3] = value
+        else:
+            # absolute: only the last zone matters
+            entry[1] = 1
+            entry[2] = value
+        entry[4] = rate
+
+    def __len__(self):
+        return len(self._pending)
+
+    def next_deadline(self):
+        if not self._pending:
+            return None
+        return min(entry[0] for entry in self._pending.values())
+
+    def flush(self, events, now, force=False):
+        # append the due keys to `events`
+        for controller in list(self._pending):
+            entry = self._pending[controller]
+            if not force and entry[0] > now:
+                continue
+            net = entry[1]
+            value = net > 0 and entry[2] or entry[3]
+            count = abs(net)
+            rate = entry[4]
+            if not count or value is None:
+                del self._pending[controller]
+                continue
+            if rate is None:
+                events.extend([("key", value)] * count)
+                del self._pending[controller]
+                continue
+            (interval, accumulate) = rate
+            last = self._last.get(value)
+            if last is not None and now - last < interval:
+                if accumulate:
+                    # too early: wait for the next slot
+                    entry[0] = last + interval
+                else:
+                    self.dropped += count
+                    del self._pending[controller]
+                continue
+            events.append(("key", value))
+            self._last[value] = now
+            count -= 1
+            if count and accumulate:
+                entry[0] = now + interval
+                entry[1] = net > 0 and count or -count
+            else:
+                self.dropped += count
+                del self._pending[controller]
+
+
+class Engine(object):
+    # MIDI to keystroke translation, without any GUI
+
+    def __init__(self, keymap=None, output=None, absolute=None, stats=None,
+                 cc_window=None, chord_window=None, profile=None,
+                 mouse_rate=None):
+        # (layer, device) -> KeyMap, '' for the base layer and for the
+        # layout shared by all devices
+        self.keymaps = {('', ''): keymap or KeyMap()}
+        self.output = output or make_output_backend(stats=stats)
+        self.absolute = ABSOLUTE_CTL if absolute is None else absolute
+        self.stats = stats
+        self.coalescer = CCCoalescer(
+            CC_WINDOW if cc_window is None else cc_window)
+        self.macros = MacroPlayer()
+        self.mouse = MouseMotion(mouse_rate)
+        self.commands = CommandRunner()
+        self.chord_window = (
+            CHORD_WINDOW if chord_window is None else chord_window)
+        self._now = 0.0
+        # device -> KeyState
+        self._states = {}
+        # device -> ChordState
+        self._chords = {}
+        # device -> {key | channel << CHANNEL_SHIFT, or chord key -> (event,
+        # value)} releasing the keys and mouse buttons held down, whatever
+        # the layer when released
+        self._pressed = {}
+        # layer of the keymaps: the profile unless a switch is held or
+        # toggled, see switch_layer()
+        self.default_profile = PROFILE if profile is None else profile
+        self.profile = self.layer = self.default_profile
+        # (device, key) of the held switches -> layer to restore
+        self._momentary = {}
+        # profile to use from the next batch, set by follow_window()
+        self._next_profile = None
+        self._output_events = []
+        self.select_device('')
+        self.start_commands()
+
+    def set_layouts(self, layouts, keymaps=None):
+        # layouts: (layer, device) -> bindings, compiled unless `keymaps`
+        # is given; the tables are swapped between two batches
+        self.keymaps = keymaps or compile_layouts(layouts)
+        self.select_device(self._device)
+        self.start_commands()
+
+    def start_commands(self):
+        # the command threads are ready before the first command
+        for keymap in self.keymaps.values():
+            for (kind, _) in keymap.actions.values():
+                if kind == 'command':
+                    self.commands.start()
+                    return
+
+    def set_profile(self, profile):
+        # layer used when no switch is held or toggled
+        self._next_profile = None
+        self._momentary.clear()
+        self.profile = profile
+        self.select_layer(profile)
+
+    def follow_window(self, window_class):
+        # from WindowFollower: the layer named after the window class (case
+        # insensitive), else the default profile
+        layers = set(layer for (layer, _) in self.keymaps if layer)
+        profile = self.default_profile
+        if window_class in layers:
+            profile = window_class
+        else:
+            for layer in layers:
+                if layer.lower() == window_class.lower():
+                    profile = layer
+        self._next_profile = profile
+
+    def select_layer(self, layer):
+        # a pointer swap: the layer applies from the next message
+        self.layer = layer
+        self.select_device(self._device)
+
+    def select_device(self, device):
+        # tables and state used for the messages of `device`
+        self._device = device
+        layer = self.layer
+        keymaps = self.keymaps
+        self.keymap = (
+            keymaps.get((layer, device)) or keymaps.get((layer, '')) or
+            keymaps.get(('', device)) or keymaps[('', '')])
+        try:
+            self._state = self._states[device]
+        except KeyError:
+            self._state = self._states[device] = KeyState()
+        try:
+            self._chord = self._chords[device]
+            self._down = self._pressed[device]
+        except KeyError:
+            self._chord = self._chords[device] = ChordState()
+            self._down = self._pressed[device] = {}
+
+    def process(self, messages):
+        self._now = time.monotonic()
+        if self._next_profile is not None:
+            self.set_profile(self._next_profile)
+        if self.stats is not None:
+            return self._process_timed(messages)
+        for command in messages:
+            if command.device != self._device:
+                self.select_device(command.device)
+            key = self.encode(command)
+            if key is None:
+                if command[0] == DEVICE_RESET:
+                    self.release_device(command.device)
+                continue
+            if command[0] < 0xA0 and (
+                    self.keymap.chord_notes or self._chord.active or
+                    self._chord.held):
+                if self.chord_note(command, key):
+                    continue
+            self.send_keystroke(command, key)
+        self.tick(self._now)
+
+    def _process_timed(self, messages):
+        monotonic = time.monotonic
+        add = self.stats.add
+        for command in messages:
+            start = monotonic()
+            add('queue', start - command.time)
+            if command.device != self._device:
+                self.select_device(command.device)
+            key = self.encode(command)
+            if key is not None:
+                self.dispatch(command, key)
+            elif command[0] == DEVICE_RESET:
+                self.release_device(command.device)
+            add('translate', monotonic() - start)
+        start = monotonic()
+        self.tick(self._now)
+        end = monotonic()
+        add('dispatch', end - start)
+        for command in messages:
+            add('total', end - command.time)
+
+    def release_device(self, device):
+        # `device` is gone or reset: release the keys, buttons and layer
+        # switches it holds, and start again from a blank state
+        if device not in self._states:
+            return
+        self.select_device(device)
+        chord = self._chord
+        self.resolve_chord(chord)
+        for release in self._down.values():
+            self.emit(*release)
+        del self._states[device]
+        del self._chords[device]
+        del self._pressed[device]
+        for held in list(self._momentary):
+            if held[0] == device:
+                self.select_layer(self._momentary.pop(held))
+        self.select_device(device)
+
+    def encode(self, command):
+        # key of the message, whatever its channel: 0x8nn/0x9nn for the
+        # notes (| velocity layer << 12), 0xBnn for the controllers (| zone
+        # << 12 in absolute mode), None for the other messages; the key
+        # id is key & 0xFFF
+        keyini = (command[0] >> 4)
+        if keyini == 0x8:
+            return 0x800 | command[1]
+        elif keyini == 0xB:
+            key = 0xB00 | command[1]
+            if self.absolute:
+                # from the zone of the previous message (hysteresis)
+                last = self._state.cc_zones[
+                    (command[0] & 0xF) << 7 | command[1]]
+                return key | self.keymap.zones[key][
+                    last << 7 | command[2]] << 12
+            return key
+        elif keyini == 0x9:
+            if command[2] == 0:
+                return 0x800 | command[1]
+            key = 0x900 | command[1]
+            return key | self.keymap.zones[key][command[2]] << 12
+        return None
+
+    def dispatch(self, command, key):
+        if command[0] < 0xA0 and (self.keymap.chord_notes or
+                                  self._chord.held or self._chord.active):
+            if self.chord_note(command, key):
+                return
+        self.send_keystroke(command, key)
+
+    def chord_note(self, command, key):
+        # True when the note is held back or belongs to a pressed chord
+        chord = self._chord
+        bit = 1 << command[1]
+        if key >> 8 == 0x8:
+            if chord.held & bit:
+                # released within the window: the chord is complete
+                self.resolve_chord(chord)
+            for notes in list(chord.active):
+                if notes & bit:
+                    held = chord.active.pop(notes)
+                    if held is not None:
+                        if self._momentary:
+                            self.switch_layer("keyup", held)
+                        release = self._down.pop(held, None)
+                        if release is not None:
+                            self.emit(*release)
+                    if notes ^ bit:
+                        chord.active[notes ^ bit] = None
+                    return True
+            return False
+        keymap = self.keymap
+        held = chord.held | bit
+        if not keymap.chord_notes & bit or not (
+                held in keymap.chords or held in keymap.chord_prefixes):
+            # can not be a chord with the held notes
+            self.resolve_chord(chord)
+            if not keymap.chord_notes & bit:
+                # notes out of any chord are sent at once
+                return False
+            held = bit
+        if not chord.held:
+            chord.deadline = self._now + self.chord_window
+        chord.held = held
+        chord.pending.append((command, key))
+        if held in keymap.chords and held not in keymap.chord_prefixes:
+            # no bigger chord to wait for
+            self.resolve_chord(chord)
+        return True
+
+    def resolve_chord(self, chord):
+        # send the chord of the held notes, or the notes one by one
+        if not chord.held:
+            return
+        (held, pending) = (chord.held, chord.pending)
+        chord.held = 0
+        chord.pending = []
+        chord.deadline = None
+        binding = self.keymap.chords.get(held)
+        if binding is None:
+            for (command, key) in pending:
+                self.send_keystroke(command, key)
+            return
+        (value, key_type) = binding
+        # state 1: hit the key, nothing on release
+        keyevt = key_type and "key" or "keydown"
+        key = chord.active[held] = CHORD_KEY | held
+        keymap = self.keymap
+        if keymap.switches and self.switch_layer(keyevt, key):
+            return
+        if keymap.actions and value in keymap.actions:
+            self.run_action(keyevt, value, key)
+            return
+        if keyevt == "keydown":
+            self._down[key] = ("keyup", value)
+        self.emit(keyevt, value)
+
+    def emit(self, keyevt, value):
+        coalescer = self.coalescer
+        if len(coalescer) and not coalescer.window:
+            # keep the order of the batch
+            coalescer.flush(self._output_events, self._now, True)
+        self._output_events.append((keyevt, value))
+
+    def run_action(self, keyevt, value, held=None):
+        # held: key | channel << CHANNEL_SHIFT of the MIDI key
+        (kind, data) = self.keymap.actions[value]
+        if kind == 'mouse':
+            (axis, amount) = data
+            if axis is None:
+                # the button follows the MIDI key
+                if keyevt == "keydown":
+                    self._down[held] = ("mouseup", amount)
+                self.emit(MOUSE_BUTTON_EVENTS[keyevt], amount)
+            elif keyevt != "keyup":
+                self.mouse.add(axis, amount, self._now)
+        elif keyevt == "keyup":
+            return
+        elif kind == 'macro':
+            self.play_macro(value)
+        else:
+            self.commands.run(data)
+
+    def play_macro(self, value):
+        coalescer = self.coalescer
+        if len(coalescer) and not coalescer.window:
+            coalescer.flush(self._output_events, self._now, True)
+        self.macros.play(value, self.keymap.actions[value][1], self._now,
+                         self._output_events)
+
+    def send_keystroke(self, midikey, keypress):
+        # keypress: encoded key, key: its key id
+        key = keypress & 0xFFF
+        keyevt = None
+        channel = midikey[0] & 0xF
+        # slot of the note or controller in the KeyState arrays
+        slot = channel << 7 | midikey[1]
+        state = self._state
+        (values, types) = self.keymap.channels[channel]
+
+        # TODO: use same index ranges
+        # on keypress and continuous controller
+        kidx = ((self.absolute or ((key >> 8) <= 0x9)) and keypress or
+                key << 1)
+        keytype = (key >> 8) - (types[kidx] and 8 or 0)
+        if keytype == 0x0:
+            keyevt = "key"
+
+        elif keytype == 0x1:
+            keyevt = "key"
+
+        elif keytype == 0x3:
+            if not self.absolute:
+                keyevt = "keydown"
+                if midikey[2] < 63:
+                    # Zero and/or decreasing
+                    state.cc_directions[slot] = 0
+                    key = key << 1
+                elif midikey[2] > 65:
+                    # Increasing
+                    state.cc_directions[slot] = 1
+                    key = (key << 1) | 0x1
+                elif state.cc_directions[slot] != NO_VALUE:
+                    # neutral
+                    key = (key << 1) | state.cc_directions[slot]
+                    keyevt = "keyup"
+            else:
+                # pressed while the pot is in the zone
+                if state.cc_zones[slot] == keypress >> 12:
+                    return
+                state.cc_zones[slot] = keypress >> 12
+                # release the key of the previous zone, as pressed
+                held = state.cc_keys[slot]
+                if held:
+                    release = self._down.pop(
+                        held | channel << CHANNEL_SHIFT, None)
+                    if release is not None:
+                        self.emit(*release)
+
+                # Press next key
+                keyevt = "keydown"
+                state.cc_keys[slot] = keypress
+                key = keypress
+
+        elif keytype == 0x8:
+            held = state.note_keys[slot]
+            if held:
+                key = held
+                state.note_keys[slot] = 0
+            keyevt = "keyup"
+
+        elif keytype == 0x9:
+            keyevt = "keydown"
+            state.note_keys[slot] = keypress
+            key = keypress
+
+        elif keytype == 0xB:
+            if not self.absolute:
+                last = state.cc_values[slot]
+                state.cc_values[slot] = midikey[2]
+                if last == NO_VALUE:
+                    return
+                if midikey[2] < last or midikey[2] == 0:
+                    # Zero and/or decreasing
+                    key = key << 1
+                else:
+                    # Increasing
+                    key = (key << 1) | 0x1
+            else:
+                # hit when the pot enters the zone
+                if state.cc_zones[slot] == keypress >> 12:
+                    return
+                state.cc_zones[slot] = keypress >> 12
+                key = keypress
+            keyevt = "key"
+
+        if keyevt:
+            keymap = self.keymap
+            if keymap.switches or self._momentary:
+                if self.switch_layer(keyevt, key):
+                    return
+            channel <<= CHANNEL_SHIFT
+            if keyevt == "keyup":
+                # what the key pressed, whatever the layer now, if any
+                release = self._down.pop(key | channel, None)
+                if release is not None:
+                    self.emit(*release)
+                return
+            value = values[key]
+            if keymap.actions and value in keymap.actions:
+                # whatever the coalescing
+                self.run_action(keyevt, value, key | channel)
+                return
+            if value is None:
+                return
+            if keyevt == "keydown":
+                self._down[key | channel] = ("keyup", value)
+            coalescer = self.coalescer
+            if keytype == 0xB:
+                if self.absolute:
+                    coalescer.add((self._device, key & 0xFFF | channel), 0,
+                                  value, keymap.rates.get(key), self._now)
+                else:
+                    coalescer.add((self._device, key >> 1 | channel),
+                                  key & 1 and 1 or -1, value,
+                                  keymap.rates.get(key), self._now)
+                return
+            self.emit(keyevt, value)
+
+    def switch_layer(self, keyevt, key):
+        # True when `key` switches layers: held (keydown, restored on
+        # keyup) or toggled (key hit, back to the profile)
+        held = (self._device, key)
+        if keyevt == "keyup" and held in self._momentary:
+            self.select_layer(self._momentary.pop(held))
+            return True
+        layer = self.keymap.switches.get(key)
+        if layer is None:
+            return False
+        if keyevt == "keydown":
+            self._momentary[held] = self.layer
+            self.select_layer(layer)
+        elif keyevt == "key":
+            self.select_layer(self.profile if self.layer == layer else layer)
+        return True
+
+    def next_deadline(self):
+        # time when tick() has keys to send, or None
+        deadlines = [chord.deadline for chord in self._chords.values()
+                     if chord.deadline is not None]
+        for deadline in (self.coalescer.next_deadline(),
+                         self.macros.next_deadline(), self.mouse.deadline):
+            if deadline is not None:
+                deadlines.append(deadline)
+        return deadlines and min(deadlines) or None
+
+    def tick(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        for device, chord in list(self._chords.items()):
+            if chord.deadline is not None and chord.deadline <= now:
+                # window elapsed: no more notes for a chord
+                self.select_device(device)
+                self.resolve_chord(chord)
+        if len(self.macros):
+            self.macros.flush(self._output_events, now)
+        if self.mouse.deadline is not None:
+            self.mouse.flush(self._output_events, now)
+        coalescer = self.coalescer
+        if len(coalescer):
+            coalescer.flush(
+                self._output_events, now, not coalescer.window)
+        self.flush_output()
+
+    def counters(self):
+        counters = {
+            'cc merged': self.coalescer.merged,
+            'cc dropped': self.coalescer.dropped,
+        }
+        counters.update(self.output.counters())
+        counters.update(self.commands.counters())
+        return counters
+
+    def flush_output(self):
+        # keystrokes of a batch are emitted in one call, in order
+        if self._output_events:
+            events = self._output_events
+            self._output_events = []
+            self.output.send(events)
 
-class TkWindow(tk.Frame):
+    def close(self):
+        # no key left pressed by a macro, nor by a MIDI key or chord whose
+        # release or device reset will not be read
+        if len(self.macros):
+            self.macros.cancel(self._output_events)
+        for pressed in self._pressed.values():
+            for release in pressed.values():
+                self.emit(*release)
+            pressed.clear()
+        self.flush_output()
+        self.commands.close()
+        self.output.close()
 
-    def __init__(self, parent):
-        tk.Frame.__init__(self, parent)
+
+class TkWindow(object):
+
+    def __init__(self, parent, stats=None):
+        self.frame = tk.Frame(parent)
         self.parent = parent
         self.parent.bind('<KeyPress>', self.onKeyPress)
-        self.midikb = None
-        self._midi_key_list = []
-        self._midi_key_values = {}
-        self._midi_key_types = {}
+        self.engine = Engine(stats=stats)
+        self.midikb = open_keyboard(stats=stats)
+        # codes of the MIDI keys of the layout (see binding_code)
+        self._midi_keys = set()
+        # keystroke -> MIDI keys bound to it
+        self._keystrokes = {}
+        # (layer, device) -> {midikey -> [type, key id, modifier, key,
+        # abs, options]}, '' for the base layer and all devices; the tree
+        # is a view of the layout being edited
+        self._layouts = {('', ''): {}}
+        self._layout = ('', '')
+        self._bindings = self._layouts[('', '')]
         self._programming_mode = tk.IntVar()
         self._tree_selection = None
+        self._tick = None
+        self._tick_deadline = None
+        # programming mode: notes pressed since the last release
+        self._chord_notes = 0
+        # the tree only shows `_visible` rows of the layout from `_offset`:
+        # column -> (sort values, MIDI keys) sorted on the column, built
+        # when first sorted on; `_rows` are the keys of `_sort_column`
+        # matching the search
+        self._orders = {}
+        self._sort_column = 1
+        self._rows = []
+        self._offset = 0
+        self._visible = 20
         self.initUI()
         self.read_configs()
-        if len(self._cbox_device.get()):
+        self.watcher = ConfigWatcher(DEFAULT_CONFIG_FILE)
+        self.follower = None
+        if FOLLOW_WINDOW:
+            self.follower = WindowFollower(self.engine.follow_window)
+        # Tk wakes us up only when the reader has queued messages
+        self.frame.tk.createfilehandler(
+            self.midikb.fileno(), tk.READABLE, self.check_midi_device)
+        self.frame.tk.createfilehandler(
+            self.watcher.fileno(), tk.READABLE, self.reload_configs)
+        if len(self._cbox_device.get()) and not REPLAY_FILE:
             self.connect_to_device()
 
     def initUI(self):
         self.parent.title("midi2dt")
-        self.pack(fill="both", expand=True)
+        self.frame.pack(fill="both", expand=True)
 
-        frame1 = ttk.Frame(self)
+        frame1 = ttk.Frame(self.frame)
         frame1.pack(side="left", fill="both", expand=True, padx=5, pady=5)
+        frame1_0 = ttk.Frame(frame1)
+        frame1_0.pack(side="top", fill="x", expand=False)
         frame1_1 = ttk.Frame(frame1)
         frame1_1.pack(side="top", fill="both", expand=True)
         frame1_2 = ttk.Frame(frame1)
         frame1_2.pack(side="bottom", fill="both", expand=False)
 
-        frame2 = ttk.Frame(self)
+        frame2 = ttk.Frame(self.frame)
         frame2.pack(side="right", fill="y", expand=False, padx=5, pady=5)
 
         tree_headers = [
@@ -191,18 +2581,33 @@ class TkWindow(tk.Frame):
             ('Key', 90),
             ('Abs', 5)
         ]
+        label = ttk.Label(frame1_0, text='Search')
+        label.pack(side='left', padx=5)
+        self._search = tk.StringVar()
+        self._search_box = ttk.Entry(frame1_0, textvariable=self._search)
+        self._search_box.pack(side='left', fill='x', expand=True)
+        self._search.trace_add('write', self.filter_rows)
+
+        # rows of a known height, to know how many fit
+        self._row_height = tkFont.Font().metrics('linespace') + 4
+        ttk.Style().configure('Treeview', rowheight=self._row_height)
         self._tree = ttk.Treeview(
             frame1_1,
             columns=[name for name, _ in tree_headers],
             show="headings",
-            height=20
+            height=self._visible
         )
         self._tree.pack(side='left', fill='both', expand=True)
         self._tree.bind('<<TreeviewSelect>>', self.selected_item)
         self._tree.bind('<<TreeviewClose>>', self.onMouseClick)
         self._tree.bind('<<TreeviewOpen>>', self.onMouseClick)
-        for column, width in tree_headers:
-            self._tree.heading(column, text=column)
+        self._tree.bind('<Configure>', self.resize_tree)
+        for event in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self._tree.bind(event, self.scroll_wheel)
+        for index, (column, width) in enumerate(tree_headers):
+            self._tree.heading(
+                column, text=column,
+                command=lambda index=index: self.sort_treeview(index))
             self._tree.column(
                 column,
                 width=(
@@ -210,41 +2615,81 @@ class TkWindow(tk.Frame):
                     width),
                 anchor='w')
 
-        vsb = ttk.Scrollbar(
+        # scrolls the rows of the model, not the tree
+        self._vsb = ttk.Scrollbar(
             frame2,
             orient="vertical",
-            command=self._tree.yview)
-        vsb.pack(side='right', fill='y')
-        self._tree.configure(yscrollcommand=vsb.set)
+            command=self.yview)
+        self._vsb.pack(side='right', fill='y')
 
         check = ttk.Checkbutton(
             frame1_2,
             text='Programming mode',
             variable=self._programming_mode)
         check.pack(side='left', padx=5, pady=5)
+        if self.engine.stats is not None:
+            self._status = tk.StringVar()
+            status = ttk.Label(frame1, textvariable=self._status)
+            status.pack(side='bottom', fill='x', padx=5)
+            self.update_status()
         self._cbox_device = tk.StringVar()
-        try:
-            device_options = subprocess.check_output(
-                'find /dev/ -type d ! \
-                    -perm -g+r,u+r,o+r \
-                    -prune -o -name *midi* \
-                    -print'.split()
-            )
-            cbox = ttk.Combobox(
-                frame1_2,
-                textvariable=self._cbox_device,
-                values=device_options)
-            cbox.pack(side='bottom', padx=5, pady=5)
-            cbox.set(device_options.split()[0])
-        except IndexError:
-            print("No midi device detected ! Leave...")
-            exit()
+        device_options = [device.path for device in find_midi_devices()]
+        # devices plugged later are listed when the list is opened
+        self._device_box = ttk.Combobox(
+            frame1_2,
+            textvariable=self._cbox_device,
+            values=device_options,
+            postcommand=self.list_devices)
+        self._device_box.pack(side='bottom', padx=5, pady=5)
+        if device_options:
+            self._device_box.set(device_options[0])
+        else:
+            print("No midi device detected, plug one and connect to it")
+        self._cbox_layout = tk.StringVar()
+        cbox = ttk.Combobox(
+            frame1_2,
+            textvariable=self._cbox_layout,
+            values=[ALL_DEVICES] + device_options,
+            state='readonly')
+        cbox.pack(side='bottom', padx=5, pady=5)
+        cbox.set(ALL_DEVICES)
+        cbox.bind('<<ComboboxSelected>>', self.select_layout)
+        # a new layer is added by typing its name
+        self._cbox_layer = tk.StringVar()
+        self._layer_box = ttk.Combobox(
+            frame1_2,
+            textvariable=self._cbox_layer,
+            values=[BASE_LAYER])
+        self._layer_box.pack(side='bottom', padx=5, pady=5)
+        self._layer_box.set(BASE_LAYER)
+        self._layer_box.bind('<<ComboboxSelected>>', self.select_layout)
+        self._layer_box.bind('<Return>', self.select_layout)
 
         button = ttk.Button(
             frame1_2,
             text='Save configs',
             command=self.save_configs)
         button.pack(side='right', padx=5, pady=5)
+        button = ttk.Button(
+            frame1_2,
+            text='Layer switch',
+            command=self.bind_layer_switch)
+        button.pack(side='right', padx=5, pady=5)
+        button = ttk.Button(
+            frame1_2,
+            text='Macro',
+            command=self.bind_macro)
+        button.pack(side='right', padx=5, pady=5)
+        button = ttk.Button(
+            frame1_2,
+            text='Action',
+            command=self.bind_action)
+        button.pack(side='right', padx=5, pady=5)
+        button = ttk.Button(
+            frame1_2,
+            text='Disconnect',
+            command=self.disconnect_device)
+        button.pack(side='right', padx=5, pady=5)
         button = ttk.Button(
             frame1_2,
             text='Connect to device',
@@ -254,226 +2699,409 @@ class TkWindow(tk.Frame):
         # as default when no configuration has been set
         self._programming_mode.set(0)
 
+    def update_status(self):
+        (count, p50, p99, top) = self.engine.stats.summary('total')
+        output_p99 = self.engine.stats.summary('output')[2]
+        counters = self.engine.counters()
+        counters.update(self.midikb.counters())
+        self._status.set(
+            "latency: {0} events, p50 {1:.2f} ms, p99 {2:.2f} ms, "
+            "max {3:.2f} ms, output p99 {4:.2f} ms, queued {5}, "
+            "cc merged {6}, dropped {7}, late MIDI dropped {8}".format(
+                count, p50 * 1e3, p99 * 1e3, top * 1e3, output_p99 * 1e3,
+                counters.get('output queued', 0),
+                counters['cc merged'], counters['cc dropped'],
+                counters['midi dropped'] + counters['midi stale']))
+        self.frame.after(1000, self.update_status)
+
+    def list_devices(self):
+        self._device_box['values'] = [
+            device.path for device in find_midi_devices()]
+
     def connect_to_device(self):
-        self.midikb = MidiKeyboard(self._cbox_device.get())
+        self.midikb.add_device(self._cbox_device.get())
+
+    def disconnect_device(self):
+        self.midikb.remove_device(self._cbox_device.get())
+
+    def select_layout(self, event=None):
+        device = self._cbox_layout.get()
+        layer = self._cbox_layer.get().strip()
+        self.show_layout((
+            '' if layer in ('', BASE_LAYER) else layer,
+            '' if device == ALL_DEVICES else device))
+
+    def show_layout(self, layout):
+        # fill the tree with the bindings of `layout`: (layer, device)
+        self._layout = layout
+        self._bindings = bindings = self._layouts.setdefault(layout, {})
+        self._layer_box['values'] = [BASE_LAYER] + sorted(
+            set(layer for (layer, _) in self._layouts if layer))
+        self._midi_keys = set(binding_code(midikey) for midikey in bindings)
+        self._keystrokes = {}
+        for midikey in bindings:
+            self._index_keystroke(midikey)
+        self._orders = {}
+        self._offset = 0
+        self._tree_selection = None
+        self.sort_treeview(self._sort_column)
+
+    def render_rows(self):
+        # the tree holds the visible rows only: the few ones from `_offset`
+        rows = self._rows
+        self._offset = max(0, min(self._offset, len(rows) - self._visible))
+        tree = self._tree
+        tree.delete(*tree.get_children())
+        bindings = self._bindings
+        for midikey in rows[self._offset:self._offset + self._visible]:
+            tree.insert('', 'end', midikey, tags=midikey,
+                        values=bindings[midikey][:5])
+        if self._tree_selection and tree.exists(self._tree_selection[0]):
+            tree.selection_set(self._tree_selection[0])
+        if rows:
+            self._vsb.set(self._offset / len(rows),
+                          min(1.0, (self._offset + self._visible) / len(rows)))
+        else:
+            self._vsb.set(0.0, 1.0)
+
+    def scroll_to(self, offset):
+        offset = max(0, min(offset, len(self._rows) - self._visible))
+        if offset != self._offset:
+            self._offset = offset
+            self.render_rows()
+
+    def yview(self, *args):
+        # scrollbar command: moveto fraction, or scroll count units/pages
+        if args[0] == 'moveto':
+            self.scroll_to(int(round(float(args[1]) * len(self._rows))))
+        elif args[0] == 'scroll':
+            count = int(args[1])
+            if args[2] == 'pages':
+                count *= self._visible
+            self.scroll_to(self._offset + count)
+
+    def scroll_wheel(self, event):
+        up = event.num == 4 or event.delta > 0
+        self.yview('scroll', -TREE_WHEEL_ROWS if up else TREE_WHEEL_ROWS,
+                   'units')
+        return 'break'
+
+    def resize_tree(self, event):
+        # as many rows as fit below the headings
+        visible = max(1, event.height // self._row_height - 1)
+        if visible != self._visible:
+            self._visible = visible
+            self.render_rows()
+
+    def row_index(self, midikey):
+        # index of the row of `midikey` in the rows, None if not shown
+        if self._search.get().strip():
+            try:
+                return self._rows.index(midikey)
+            except ValueError:
+                return None
+        # the rows are the sort order
+        values = self._orders[self._sort_column][0]
+        index = bisect.bisect_left(
+            values, self._sort_value(midikey, self._sort_column))
+        if index < len(values) and self._rows[index] == midikey:
+            return index
+        return None
+
+    def show_row(self, midikey, index):
+        # scroll to the row of `midikey`, at `index` in the rows, and
+        # select it
+        if not self._offset <= index < self._offset + self._visible:
+            self._offset = index - self._visible // 2
+        self._tree_selection = (str(midikey),)
+        self.render_rows()
 
     def read_configs(self,
                      file_format=DEFAULT_CONFIG_FORMAT,
                      file_name=DEFAULT_CONFIG_FILE):
+        keymaps = None
         try:
-            with open(file_name, "r") as f:
-                options = json.load(f)
-            for line in options:
-                line["tags"][0] = int(line['tags'][0], 16)
-                self._midi_key_list.append(line["tags"][0])
-                (v1, v2, v3, v4, v5) = line["values"]
-                self._ins(line["tags"][0],
-                          v1, v2, v3, v4, v5)
-            self.sort_treeview(column=1)
+            (self._layouts, keymaps) = load_config(file_name)
         except Exception:
             self._programming_mode.set(1)
+        self.show_layout(self._layout)
+        self.engine.set_layouts(self._layouts, keymaps)
+
+    def reload_configs(self, *args):
+        # the file changed on disk: unsaved edits are lost
+        config = self.watcher.read()
+        if config is None:
+            return
+        (self._layouts, keymaps) = config
+        self.show_layout(self._layout)
+        self.engine.set_layouts(self._layouts, keymaps)
 
     def save_configs(self,
                      file_format=DEFAULT_CONFIG_FORMAT,
                      file_name=DEFAULT_CONFIG_FILE):
         if file_format == 'json':
             options = []
-            for child in self._tree.get_children():
-                key = self._tree.item(child)
-                key["tags"][0] = hex(key["tags"][0])
-                options.append(key)
+            for layout in sorted(self._layouts):
+                (layer, device) = layout
+                bindings = self._layouts[layout]
+                if layout == self._layout:
+                    keys = self._order(self._sort_column)[1]
+                else:
+                    keys = sorted(bindings)
+                for midikey in keys:
+                    row = bindings[midikey]
+                    line = {
+                        "image": "",
+                        "open": 0,
+                        "tags": [hex(midikey)],
+                        "text": "",
+                        "values": row[:5]}
+                    if len(row) > 5:
+                        line.update(row[5])
+                    if device:
+                        line["device"] = device
+                    if layer:
+                        line["layer"] = layer
+                    options.append(line)
             with open(file_name, "w") as f:
                 json.dump(options, f, sort_keys=True, indent=4)
+            # not a change to reload
+            self.watcher.reset()
 
-    def send_keystroke(self, midikey, key, keypress):
-        # key = keyid
-        # keypress = mod key
-        keyevt = None
+    def rebuild_keymap(self):
+        # bindings changed: compile new tables and swap them
+        self.engine.set_layouts(self._layouts)
 
-        # TODO: use same index ranges
-        # on keypress and continuous controller
-        kidx = ((ABSOLUTE_CTL or ((key >> 8) <= 0x9)) and keypress or key << 1)
-        keytype = (
-            (key >> 8) -
-            (
-                kidx in self._midi_key_types
-                and self._midi_key_types[kidx]
-                and 8
-                or 0)
-        )
-        # print(midikey, hex(kidx),hex(key),hex(keypress),hex(keytype))
-        if keytype == 0x0:
-            keyevt = "key"
+    def bind_layer_switch(self):
+        # bind the selected MIDI key to a layer, see Engine.switch_layer()
+        if not self._tree_selection:
+            return
+        layer = tkSimpleDialog.askstring(
+            'Layer switch', 'Layer selected by this key:',
+            parent=self.parent)
+        if not layer:
+            return
+        midikey = int(self._tree_selection[0])
+        self._set(midikey, 2, '-')
+        self._set(midikey, 3, LAYER_PREFIX + layer.strip())
+        self.rebuild_keymap()
 
-        elif keytype == 0x1:
-            keyevt = "key"
+    def bind_macro(self):
+        # bind the selected MIDI key to a sequence of keys, see MacroPlayer
+        if not self._tree_selection:
+            return
+        midikey = int(self._tree_selection[0])
+        row = self._bindings[midikey]
+        value = str(row[3])
+        steps = tkSimpleDialog.askstring(
+            'Macro', 'Keys and delays (e.g. Ctrl+c 100ms Ctrl+v):',
+            initialvalue=(value[len(MACRO_PREFIX):]
+                          if value.startswith(MACRO_PREFIX) else ''),
+            parent=self.parent)
+        if not steps or not steps.strip():
+            return
+        options = row[5]
+        retrigger = tkSimpleDialog.askstring(
+            'Macro', 'Hit again while playing: cancel or queue',
+            initialvalue=options.get('retrigger', 'cancel'),
+            parent=self.parent)
+        if retrigger and retrigger.strip() in ('cancel', 'queue'):
+            options['retrigger'] = retrigger.strip()
+        self._set(midikey, 2, '-')
+        self._set(midikey, 3, MACRO_PREFIX + ' '.join(steps.split()))
+        self.rebuild_keymap()
 
-        elif keytype == 0x3:
-            if not ABSOLUTE_CTL:
-                keyevt = "keydown"
-                if (midikey[2] == 0) or (midikey[2] < 63):
-                    # Zero and/or decreasing
-                    self._midi_key_values[str(key)] = 0
-                    key = (key << 1) | 0x0
-                elif (midikey[2] > 65):
-                    # Increasing
-                    self._midi_key_values[str(key)] = 1
-                    key = (key << 1) | 0x1
-                elif str(key) in self._midi_key_values.keys():
-                    # neutral
-                    key = (
-                        (self._midi_key_values[str(key)] == 0) and
-                        ((key << 1) | 0x0) or
-                        ((key << 1) | 0x1))
-                    keyevt = "keyup"
-            else:
-                # Realease existing key
-                cc = midikey[1]
-                if str(cc) in self._midi_key_values.keys():
-                    keyr = self._midi_key_values[str(cc)]
-                    keyevt = "keyup"
-                    if self._tree.exists(keyr):
-                        modifier = self._tree.item(keyr, option="values")[2]
-                        value = self._tree.item(keyr, option="values")[3]
-                        if value != "<<Undefined>>":
-                            if len(modifier) > 1:
-                                value = "{}{}".format(modifier, value)
-                            # p =
-                            subprocess.Popen(["xdotool", keyevt, value])
+    def bind_action(self):
+        # bind the selected MIDI key to a command or a mouse action
+        if not self._tree_selection:
+            return
+        midikey = int(self._tree_selection[0])
+        value = str(self._bindings[midikey][3])
+        action = tkSimpleDialog.askstring(
+            'Action', 'Shell command, or mouse action (mouse:x 2, '
+            'mouse:y -2, mouse:scroll 1, mouse:hscroll 1, mouse:button 1):',
+            initialvalue=(value[len(COMMAND_PREFIX):]
+                          if value.startswith(COMMAND_PREFIX) else value
+                          if value.startswith(MOUSE_PREFIX) else ''),
+            parent=self.parent)
+        if not action or not action.strip():
+            return
+        action = action.strip()
+        if action.startswith(MOUSE_PREFIX):
+            try:
+                parse_mouse(action)
+            except ValueError as e:
+                logging.error("%s", e)
+                return
+        else:
+            action = COMMAND_PREFIX + action
+        self._set(midikey, 2, '-')
+        self._set(midikey, 3, action)
+        self.rebuild_keymap()
 
-                # Press next key
-                keyevt = "keydown"
-                # warning: can be buggy with cc and note in the same range
-                # usually note are in range 20..256 and cc in range 0..10
-                self._midi_key_values[str(midikey[1])] = keypress
-                key = keypress
+    def sort_treeview(self, column=1):
+        # rows sorted on `column`, values compared as displayed
+        self._sort_column = column
+        self.filter_rows()
 
-        elif keytype == 0x8:
-            note = str(midikey[1])
-            if note in self._midi_key_values.keys():
-                key = self._midi_key_values[note]
-            keyevt = "keyup"
+    def filter_rows(self, *args):
+        # rows of the sort order with the search text in one of their
+        # values, case-insensitive
+        keys = self._order(self._sort_column)[1]
+        text = self._search.get().strip().lower()
+        if text:
+            bindings = self._bindings
+            keys = [midikey for midikey in keys if text in ' '.join(
+                map(str, bindings[midikey][:5])).lower()]
+        self._rows = keys
+        self.render_rows()
 
-        elif keytype == 0x9:
-            keyevt = "keydown"
-            self._midi_key_values[str(midikey[1])] = keypress
-            key = keypress
+    def _order(self, column):
+        # (sort values, MIDI keys) of the layout sorted on `column`
+        order = self._orders.get(column)
+        if order is None:
+            pairs = sorted((self._sort_value(midikey, column), midikey)
+                           for midikey in self._bindings)
+            order = ([value for (value, _) in pairs],
+                     [midikey for (_, midikey) in pairs])
+            self._orders[column] = order
+        return order
 
-        elif keytype == 0xB:
-            if not ABSOLUTE_CTL:
-                if str(key) in self._midi_key_values.keys():
-                    # print(key)
-                    if (
-                            (midikey[2] == 0) or
-                            (midikey[2] <
-                                self._midi_key_values[str(key)])
-                    ):
-                        # Zero and/or decreasing
-                        key = (key << 1) | 0x0
-                    else:
-                        # Increasing
-                        key = (key << 1) | 0x1
-                    self._midi_key_values[str(key >> 1)] = midikey[2]
-                else:
-                    self._midi_key_values[str(key)] = midikey[2]
-                    return
-            else:
-                key = keypress
-            keyevt = "key"
+    def _sort_value(self, midikey, column):
+        return (str(self._bindings[midikey][column]), str(midikey))
 
-        if keyevt:
-            if self._tree.exists(key):
-                # print("key",key)
-                modifier = self._tree.item(key, option="values")[2]
+    def _place(self, midikey, columns):
+        # add `midikey` to the orders on `columns` at its sorted position
+        for column in columns:
+            (values, keys) = self._orders[column]
+            value = self._sort_value(midikey, column)
+            index = bisect.bisect(values, value)
+            values.insert(index, value)
+            keys.insert(index, midikey)
 
-                value = self._tree.item(key, option="values")[3]
-                if value == "<<Undefined>>":
-                    return
-                if len(modifier) > 1:
-                    value = "{}{}".format(modifier, value)
-                # p =
-                subprocess.Popen(
-                    ["xdotool", keyevt, value])
-
-    def sort_treeview(self, column=0, reverse=False):
-        new_treeview = [
-            (self._tree.set(child, column), child)
-            for child in self._tree.get_children('')]
-        new_treeview.sort(reverse=reverse)
-
-        # rearrange items in sorted positions
-        for index, (value, child) in enumerate(new_treeview):
-            self._tree.move(child, '', index)
+    def _unplace(self, midikey, columns):
+        for column in columns:
+            (values, keys) = self._orders[column]
+            index = bisect.bisect_left(
+                values, self._sort_value(midikey, column))
+            del values[index]
+            del keys[index]
+
+    def _refresh(self, midikey, moved):
+        # show the change of the row of `midikey`, which `moved` in the
+        # rows when the sort order changed
+        if self._search.get().strip():
+            self.filter_rows()
+        elif moved:
+            self.render_rows()
+        elif self._tree.exists(midikey):
+            self._tree.item(midikey, values=self._bindings[midikey][:5])
+
+    def _index_keystroke(self, midikey, add=True):
+        # add (or remove) `midikey` to the keys of its keystroke
+        row = self._bindings[midikey]
+        keystroke = format_keystroke(row[2], row[3])
+        if keystroke is None:
+            return
+        midikeys = self._keystrokes.setdefault(keystroke, set())
+        if add:
+            midikeys.add(midikey)
+        else:
+            midikeys.discard(midikey)
+            if not midikeys:
+                del self._keystrokes[keystroke]
 
     def selected_item(self, tree_item):
-        self._tree_selection = self._tree.selection()
+        # kept while the row is scrolled out of the tree
+        selection = self._tree.selection()
+        if selection:
+            self._tree_selection = selection
 
     def _ins(self, midikey, typ, key_note, mod, val, key_type):
-        self._tree.insert(
-            '', 'end',
-                midikey,
-                tags=midikey,
-                values="{} {} {} {} {}".format(
-                    typ,
-                    key_note,
-                    mod or '-',
-                    val or '<<Undefined>>',
-                    key_type))
-        self._midi_key_types[midikey] = key_type
+        row = [typ.strip(), key_note, mod or '-', val or UNDEFINED_KEY,
+               parse_key_type(key_type), {}]
+        self._bindings[midikey] = row
+        self._index_keystroke(midikey)
+        self._place(midikey, list(self._orders))
+        self._refresh(midikey, True)
+
+    def _set(self, midikey, column, value):
+        keystroke = column in (2, 3)
+        resort = [column] if column in self._orders else []
+        self._unplace(midikey, resort)
+        if keystroke:
+            self._index_keystroke(midikey, False)
+        self._bindings[midikey][column] = value
+        if keystroke:
+            self._index_keystroke(midikey)
+        self._place(midikey, resort)
+        self._refresh(midikey, column == self._sort_column)
 
     def add_keys_availables(
             self, midikey=None, tags=None, values=None):
+        if midikey >= CHORD_KEY:
+            self._ins(midikey, "Chord",
+                      '+'.join(map(str, chord_notes(midikey))),
+                      "-", UNDEFINED_KEY, 0)
+            return
         key_type = (midikey & 0xF00) >> 8
         key_note = str((midikey & 0xFF))
+        channel = midikey >> CHANNEL_SHIFT
+        if channel:
+            key_note += ' ch%d' % channel
+        # velocity layer or zone
+        layer = (midikey >> 12) & 0xF
         if key_type == 0x8:
             self._ins(midikey, "Note-off",
-                      key_note, "-", "<<Undefined>>", 0)
+                      key_note, "-", UNDEFINED_KEY, 0)
         elif key_type == 0x9:
             self._ins(midikey, "Note-on" + (
                 "(middle)"
-                if midikey >> 12 == NOTE_PRESSURE_MIDDLE_DELTA
+                if layer == NOTE_PRESSURE_MIDDLE_DELTA
                 else
                 "(strong)"
-                if midikey >> 12 == NOTE_PRESSURE_STRONG_DELTA
+                if layer == NOTE_PRESSURE_STRONG_DELTA
+                else "(%d)" % (VELOCITY_CODES.index(layer) + 1)
+                if layer
                 else " "
             ),
-                key_note, "-", "<<Undefined>>", 0)
+                key_note, "-", UNDEFINED_KEY, 0)
         elif key_type == 0xb:
             if ABSOLUTE_CTL:
-                self._ins(midikey, "CC" + str(midikey >> 12) + '/10',
-                          key_note, "-", "<<Undefined>>", 0)
+                zones = max(self.engine.keymap.zones[midikey & 0xFFF])
+                self._ins(midikey, "CC%d/%d" % (layer, zones),
+                          key_note, "-", UNDEFINED_KEY, 0)
             else:
-                self._ins((midikey << 1) | 1, "CC",
-                          key_note + '+', "-", "<<Undefined>>", 0)
-                self._ins((midikey << 1) | 0, "CC",
-                          key_note + '-', "-", "<<Undefined>>", 0)
+                code = midikey & 0xFFFF
+                midikey ^= code
+                self._ins(midikey | (code << 1) | 1, "CC",
+                          key_note + '+', "-", UNDEFINED_KEY, 0)
+                self._ins(midikey | (code << 1) | 0, "CC",
+                          key_note + '-', "-", UNDEFINED_KEY, 0)
         else:
             print("%x - %s" % (key_type, key_note))
 
     def check_item(self, tree_item):
         key = int(tree_item[0])
-        self._midi_key_types[key] = (not (
-            key in self._midi_key_types and
-            self._midi_key_types[key] or 0
-        )
-        )
-        self._tree.set(
-            tree_item,
-            4,
-            self._midi_key_types[key]
-        )
+        self._set(key, 4, int(not self._bindings[key][4]))
+        self.rebuild_keymap()
 
     def onMouseClick(self, event):
         self.check_item(self._tree_selection)
 
     def onKeyPress(self, event):
         key = event.__dict__['keysym']
+        if event.__dict__.get('widget') is self._search_box:
+            # typing a search
+            return
         if not self._programming_mode.get():
             # if key == 'Return':
                 # self._programming_mode.set(1)
-            if key == 'BackSpace':
-                self._tree.set(self._tree_selection, 2, '-')
-                self._tree.set(self._tree_selection, 3, '<<Undefined>>')
+            if key == 'BackSpace' and self._tree_selection:
+                midikey = int(self._tree_selection[0])
+                self._set(midikey, 2, '-')
+                self._set(midikey, 3, UNDEFINED_KEY)
+                self.rebuild_keymap()
             return
         # Mask     Modifier         Binary
         # 0x0001  Shift.           b0000 0001
@@ -490,12 +3118,8 @@ class TkWindow(tk.Frame):
         if (self._tree_selection is not None and
                 len(self._tree_selection) > 0):
             midikey = int(self._tree_selection[0])
-            if (
-                    midikey >> 8 == 0x8 and
-                    not (
-                        midikey in self._midi_key_types and
-                        self._midi_key_types[midikey])
-            ):
+            if (midikey < CHORD_KEY and (midikey & 0xFFFF) >> 8 == 0x8 and
+                    not self._bindings[midikey][4]):
                 return
 
             if (
@@ -517,12 +3141,15 @@ class TkWindow(tk.Frame):
             if state & (1 << 6):
                 modifier = modifier + "Super+"
 
-            for child in self._tree.get_children():
-                if key == self._tree.item(child, option="values")[2]:
-                    self._tree.set(child, 3, "<<Undefined>>")
+            # a keystroke is bound to one MIDI key only
+            for other in list(self._keystrokes.get(
+                    format_keystroke(modifier, key), ())):
+                if other != midikey:
+                    self._set(other, 3, UNDEFINED_KEY)
 
-            self._tree.set(self._tree_selection, 2, modifier)
-            self._tree.set(self._tree_selection, 3, key)
+            self._set(midikey, 2, modifier)
+            self._set(midikey, 3, key)
+            self.rebuild_keymap()
 #           Useless behavior
 #             next = self._tree.next(self._tree_selection)
 #             self._tree.selection_set(next)
@@ -530,87 +3157,189 @@ class TkWindow(tk.Frame):
 #                 self._tree_selection = None
 
     def update_keys_list(self, code):
-        if code not in self._midi_key_list:
-            self._midi_key_list.append(code)
+        if code not in self._midi_keys:
+            self._midi_keys.add(code)
             self.add_keys_availables(code)
 
-    def check_midi_device(self):
-        if self.midikb:
-            if self.midikb.is_running():
-                self.after(1, self.check_midi_device)
-            else:
-                print("is not running")
-                self.after(1, self.check_midi_device)
-                return
-            command = self.midikb.read()
+    def check_midi_device(self, *args):
+        # handle the whole batch in one wakeup
+        running = self.midikb.is_running()
+        messages = self.midikb.read()
+        if self._programming_mode.get():
+            for command in messages:
+                self.handle_midi_message(command)
         else:
-            print("Midi device disappeared")
-            exit()
-        if command:
-            # print(command)
-            # Only pay attention to 0x9X Note on and 0xBX Continuous controller
-            keyini = (command[0] >> 4)
-            key = None
-            keyorig = None
-#             key = ((keyini << 8) | command[1])
-#             keyorig=key
-            if keyini == 0x8:
-                key = (0x800 | command[1])
-                keyorig = key
-            elif keyini == 0xB:
-                key = (0xB00 | command[1])
-                keyorig = key
-                if ABSOLUTE_CTL:
-                    def a(x):
-                        return round(x * 9 / 127) + 1
-                    p = command[2]
-                    val = a(p)
-                    key = (key | (val << 12))
-            elif keyini == 0x9:
-                p = command[2]
-                if p == 0:
-                    key = (0x800 | command[1])
-                    keyorig = key
-                else:
-                    key = (0x900 | command[1])
-                    keyorig = key
-                    if p > NOTE_PRESSURE_MIDDLE:
-                        if p > NOTE_PRESSURE_STRONG:
-                            key = key | NOTE_PRESSURE_STRONG_DELTA << 12
-                        else:
-                            key = key | NOTE_PRESSURE_MIDDLE_DELTA << 12
-            else:
+            self.engine.process(messages)
+            self.schedule_tick()
+        if not running:
+            print("No midi device connected")
+
+    def schedule_tick(self):
+        # keys held back by the CC coalescing are sent on time; a pending
+        # tick is moved to an earlier deadline
+        deadline = self.engine.next_deadline()
+        if deadline is None:
+            return
+        if self._tick is not None:
+            if self._tick_deadline <= deadline:
                 return
-            if (self._programming_mode.get()):
-                self.update_keys_list(key)
-                if keyini == 0xB and not ABSOLUTE_CTL:
-                    key = key << 1
-                idx = self._tree.index(key)
-                treeitem = self._tree.get_children()
-                movement = float((idx - 5) / len(treeitem))
-                self._tree.yview('moveto', movement)
-                self._tree.selection_set(key)
-            else:
-                self.send_keystroke(command, keyorig, key)
-            logging.debug('Key: %s %s', hex(key), hex(command[2]))
+            self.frame.after_cancel(self._tick)
+        self._tick_deadline = deadline
+        self._tick = self.frame.after(
+            max(0, math.ceil((deadline - time.monotonic()) * 1e3)),
+            self.engine_tick)
+
+    def engine_tick(self):
+        self._tick = None
+        self.engine.tick()
+        self.schedule_tick()
+
+    def handle_midi_message(self, command):
+        key = self.engine.encode(command)
+        if key is None:
+            return
+        keyini = command[0] >> 4
+        if keyini <= 0x9:
+            key = self.track_chord(key & 0xFFF, command[1], key)
+            if key is None:
+                return
+        if keyini == 0xB and not self.engine.absolute:
+            key = key << 1
+        if CHANNEL_KEYS and key < CHORD_KEY:
+            key = channel_key(key, command[0] & 0xF)
+        # programming mode: select (or add) the key in the tree
+        self.update_keys_list(binding_code(key))
+        index = self.row_index(key)
+        if index is None:
+            # hidden by the search
+            self._search.set('')
+            index = self.row_index(key)
+        self.show_row(key, index)
+        logging.debug('Key: %s %s', hex(key), hex(command[2]))
+
+    def track_chord(self, keyorig, note, key):
+        # the first release of several notes pressed together selects
+        # their chord instead of the note-offs
+        if keyorig >> 8 == 0x9:
+            self._chord_notes |= 1 << note
+            return key
+        (chord, self._chord_notes) = (self._chord_notes, 0)
+        if not chord:
+            # next releases of the notes of a chord: keep it selected
+            return None
+        if bin(chord).count('1') < 2:
+            return key
+        return CHORD_KEY | chord
 
     def on_closing(self):
         logging.debug('User want to close the app')
-        self.midikb.stop_thread()
+        self.frame.tk.deletefilehandler(self.midikb.fileno())
+        self.frame.tk.deletefilehandler(self.watcher.fileno())
+        self.watcher.close()
+        if self.follower is not None:
+            self.follower.close()
+        self.midikb.close()
+        self.engine.close()
         self.parent.destroy()
         logging.debug('Thanks for using this app :)')
 
 
+def report_startup(name):
+    # time since the module started to load (of which imports), and peak
+    # memory
+    logging.info(
+        "%s ready in %.1f ms (imports %.1f ms), max RSS %d kB", name,
+        (time.monotonic() - START_TIME) * 1000,
+        (IMPORTS_TIME - START_TIME) * 1000,
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+def run_loop(engine, midikb, watcher=None):
+    # dispatch the messages of `midikb` until its reader stops, and swap
+    # the configurations reloaded by `watcher`
+    poller = select.poll()
+    poller.register(midikb.fileno(), select.POLLIN)
+    if watcher is not None:
+        poller.register(watcher.fileno(), select.POLLIN)
+    running = True
+    while running:
+        deadline = engine.next_deadline()
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, math.ceil((deadline - time.monotonic()) * 1e3))
+        ready = dict(poller.poll(timeout))
+        if not ready:
+            engine.tick()
+            continue
+        if watcher is not None and watcher.fileno() in ready:
+            config = watcher.read()
+            if config is not None:
+                engine.set_layouts(*config)
+            if midikb.fileno() not in ready:
+                continue
+        # the last batch is drained once the reader has stopped
+        running = midikb.is_running()
+        engine.process(midikb.read())
+    engine.tick()
+
+
+def run_headless(devices=None, file_name=DEFAULT_CONFIG_FILE, stats=None):
+    engine = Engine(stats=stats)
+    engine.set_layouts(*load_config(file_name))
+    if not devices and not REPLAY_FILE:
+        devices = find_midi_devices()[:1]
+        if not devices:
+            print("No midi device detected ! Leave...")
+            return 1
+        logging.info("Using %s (%s)", devices[0].path,
+                     devices[0].name or 'unknown')
+        devices = [devices[0].path]
+    midikb = open_keyboard(None, stats=stats)
+    for device in devices or ():
+        midikb.add_device(device)
+    watcher = ConfigWatcher(file_name)
+    follower = None
+    if FOLLOW_WINDOW:
+        follower = WindowFollower(engine.follow_window)
+    report_startup('headless')
+    try:
+        run_loop(engine, midikb, watcher)
+        if REPLAY_FILE:
+            return 0
+        print("is not running")
+        return 1
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        if follower is not None:
+            follower.close()
+        watcher.close()
+        midikb.close()
+        engine.close()
+        counters = engine.counters()
+        counters.update(midikb.counters())
+        logging.info("%s", ", ".join(
+            "%s: %d" % item for item in sorted(counters.items())))
+
+
 def main():
     # logging.basicConfig(level=logging.DEBUG)
     logging.basicConfig(level=logging.INFO)
+    stats = None
+    if LATENCY_STATS:
+        stats = LatencyStats()
+        signal.signal(signal.SIGUSR1, stats.dump)
+        atexit.register(stats.dump)
+    if HEADLESS:
+        return run_headless(DEVICES, stats=stats)
+    import_tk()
     root = tk.Tk()
     # root.geometry("400x300")
-    app = TkWindow(root)
+    app = TkWindow(root, stats=stats)
     root.protocol("WM_DELETE_WINDOW", app.on_closing)
-    root.after(500, app.check_midi_device)
+    root.after_idle(report_startup, 'GUI')
     root.mainloop()
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
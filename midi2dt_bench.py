@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+# Benchmarks for midi2dt, no MIDI hardware nor X server needed
+import argparse
+import os
+import select
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import midi2dt
+
+
+def note_storm(count, channel=0):
+    data = bytearray()
+    for i in range(count):
+        note = 36 + i % 48
+        data += bytes((0x90 | channel, note, 100, 0x80 | channel, note, 0))
+    return bytes(data)
+
+
+def channel_notes(count, channels=16):
+    # The same notes played on every channel in turn
+    data = bytearray()
+    for i in range(count):
+        note = 36 + i // channels % 48
+        channel = i % channels
+        data += bytes((0x90 | channel, note, 100, 0x80 | channel, note, 0))
+    return bytes(data)
+
+
+def running_status(count, channel=0):
+    # Note-on with velocity 0 as note-off, one status byte for the stream
+    data = bytearray((0x90 | channel,))
+    for i in range(count):
+        note = 36 + i % 48
+        data += bytes((note, 100, note, 0))
+    return bytes(data)
+
+
+def cc_sweep(count, channel=0, controllers=4):
+    # Knobs turned back and forth over the whole range
+    data = bytearray()
+    for i in range(count):
+        step = i % 254
+        value = step if step < 127 else 253 - step
+        data += bytes((0xB0 | channel, 1 + i % controllers, value))
+    return bytes(data)
+
+
+def with_clock(stream, ppqn=24, notes_per_beat=4):
+    # Interleave realtime clock bytes inside messages
+    ratio = max(1, ppqn // notes_per_beat)
+    data = bytearray()
+    for byte in stream:
+        data += b'\xf8' * ratio
+        data.append(byte)
+    return bytes(data)
+
+
+def with_sysex(stream, every=6 * 16, size=32):
+    # SysEx dumps can not interleave, insert them between messages
+    data = bytearray()
+    for i in range(0, len(stream), every):
+        data += b'\xf0' + bytes(size) + b'\xf7'
+        data += stream[i:i + every]
+    return bytes(data)
+
+
+STREAMS = {
+    'notes': lambda n: note_storm(n),
+    'channels': lambda n: channel_notes(n),
+    'running-status': lambda n: running_status(n),
+    'cc': lambda n: cc_sweep(2 * n),
+    'clock': lambda n: with_clock(note_storm(n)),
+    'sysex': lambda n: with_sysex(note_storm(n)),
+}
+
+
+def load_streams(names, count):
+    streams = []
+    for name in names:
+        if name in STREAMS:
+            streams.append((name, STREAMS[name](count)))
+        else:
+            with open(name, 'rb') as f:
+                data = f.read()
+            if data.startswith(midi2dt.SESSION_MAGIC):
+                # recorded with --record: keep the raw stream of the
+                # first device only
+                records = list(midi2dt.read_session(name))[1:]
+                data = b''.join(chunk for (_, device, chunk) in records
+                                if device == records[0][1])
+            streams.append((os.path.basename(name), data))
+    return streams
+
+
+def synthetic_bindings(absolute=False):
+    # Every note, velocity layer and controller bound to a key
+    bindings = {}
+    for note in range(128):
+        for delta in (0, midi2dt.NOTE_PRESSURE_MIDDLE_DELTA,
+                      midi2dt.NOTE_PRESSURE_STRONG_DELTA):
+            bindings[(delta << 12) | 0x900 | note] = [
+                'Note-on', note, '-', 'a', 0]
+        if absolute:
+            for zone in range(1, 11):
+                bindings[(zone << 12) | 0xB00 | note] = [
+                    'CC', note, '-', 'b', 0]
+        else:
+            for direction in (0, 1):
+                bindings[((0xB00 | note) << 1) | direction] = [
+                    'CC', note, '-', 'b', 0]
+    return bindings
+
+
+def bench_parser(data, chunk=midi2dt.READ_BUFFER_SIZE, repeat=5):
+    best = None
+    count = 0
+    for _ in range(repeat):
+        parser = midi2dt.MidiParser()
+        count = 0
+        start = time.perf_counter()
+        for i in range(0, len(data), chunk):
+            buf = data[i:i + chunk]
+            for _ in parser.feed(buf):
+                count += 1
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+def bench_lookup(bindings, count=100000):
+    # Cost of resolving an encoded key to the keystroke to send
+    keys = list(bindings) * (count // max(1, len(bindings)) + 1)
+    keys = keys[:count]
+    results = []
+
+    try:
+        import tkinter
+        import tkinter.ttk
+        root = tkinter.Tk()
+    except Exception as e:
+        results.append(('treeview', None, 'skipped: %s' % e))
+    else:
+        tree = tkinter.ttk.Treeview(root, columns=list(range(5)))
+        for key, row in bindings.items():
+            tree.insert('', 'end', key, values=row)
+        start = time.perf_counter()
+        for key in keys:
+            if tree.exists(key):
+                modifier = tree.item(key, option="values")[2]
+                value = tree.item(key, option="values")[3]
+                if len(modifier) > 1:
+                    value = "{}{}".format(modifier, value)
+        results.append(('treeview', time.perf_counter() - start, ''))
+        root.destroy()
+
+    keymap = midi2dt.KeyMap(bindings)
+    values = keymap.values
+    start = time.perf_counter()
+    for key in keys:
+        values[key]
+    results.append(('keymap', time.perf_counter() - start, ''))
+
+    print("{0:<20s} {1:>12s}".format('lookup', 'ns/lookup'))
+    for name, elapsed, note in results:
+        if elapsed is None:
+            print("{0:<20s} {1:>12s}".format(name, note))
+        else:
+            print("{0:<20s} {1:>12.1f}".format(name, elapsed / count * 1e9))
+
+
+def bench_translate(data, absolute=False, batch=64, repeat=5):
+    # Engine.process alone, on messages parsed beforehand
+    messages = list(midi2dt.MidiParser().feed(data))
+    batches = [messages[i:i + batch] for i in range(0, len(messages), batch)]
+    best = None
+    for _ in range(repeat):
+        output = midi2dt.NullBackend()
+        engine = midi2dt.Engine(
+            midi2dt.KeyMap(synthetic_bindings(absolute)), output,
+            absolute=absolute, cc_window=0)
+        start = time.perf_counter()
+        for messages in batches:
+            engine.process(messages)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return sum(len(messages) for messages in batches), output.count, best
+
+
+def write_stream(path, data, rate=0, chunk=64):
+    # Feed the FIFO, paced at `rate` bytes per second if set
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        start = time.monotonic()
+        for i in range(0, len(data), chunk):
+            if rate:
+                delay = start + i / rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            os.write(fd, data[i:i + chunk])
+    finally:
+        os.close(fd)
+
+
+def bench_replay(data, absolute=False, rate=0, cc_window=0):
+    # FIFO -> MidiKeyboard -> Engine -> output worker -> NullBackend, like
+    # --headless
+    tmpdir = tempfile.mkdtemp(prefix='midi2dt-bench-')
+    fifo = os.path.join(tmpdir, 'midi')
+    os.mkfifo(fifo)
+    stats = midi2dt.LatencyStats()
+    output = midi2dt.NullBackend()
+    engine = midi2dt.Engine(
+        midi2dt.KeyMap(synthetic_bindings(absolute)),
+        midi2dt.AsyncOutput(output, stats=stats), absolute=absolute,
+        stats=stats, cc_window=cc_window)
+    midikb = midi2dt.MidiKeyboard(fifo, stats=stats)
+    writer = threading.Thread(
+        target=write_stream, args=(fifo, data, rate))
+    poller = select.poll()
+    poller.register(midikb.fileno(), select.POLLIN)
+    messages = 0
+    try:
+        cpu = time.process_time()
+        start = time.monotonic()
+        writer.start()
+        running = True
+        while running:
+            poller.poll()
+            # the last batch is drained after the reader has stopped
+            running = midikb.is_running()
+            batch = midikb.read()
+            messages += len(batch)
+            engine.process(batch)
+        engine.tick(float('inf'))
+        # wait for the output worker
+        engine.close()
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu
+    finally:
+        writer.join()
+        midikb.close()
+        shutil.rmtree(tmpdir)
+    return {
+        'messages': messages,
+        'events': output.count,
+        'merged': engine.counters()['cc merged'],
+        'elapsed': elapsed,
+        'cpu': cpu,
+        'stats': stats,
+    }
+
+
+def run_parser(streams):
+    print("{0:<20s} {1:>10s} {2:>10s} {3:>12s} {4:>10s}".format(
+        'parser', 'bytes', 'messages', 'msg/s', 'MB/s'))
+    for name, data in streams:
+        count, elapsed = bench_parser(data)
+        print("{0:<20s} {1:>10d} {2:>10d} {3:>12.0f} {4:>10.2f}".format(
+            name, len(data), count, count / elapsed,
+            len(data) / elapsed / 1e6))
+
+
+def run_translate(streams, absolute):
+    print("{0:<20s} {1:>10s} {2:>10s} {3:>12s} {4:>10s}".format(
+        'translate' + (' (abs)' if absolute else ''), 'messages', 'keys',
+        'msg/s', 'ns/msg'))
+    for name, data in streams:
+        (count, keys, elapsed) = bench_translate(data, absolute)
+        print("{0:<20s} {1:>10d} {2:>10d} {3:>12.0f} {4:>10.1f}".format(
+            name, count, keys, count / elapsed, elapsed / count * 1e9))
+
+
+def run_replay(streams, absolute, rate, cc_window):
+    print("{0:<20s} {1:>9s} {2:>9s} {3:>9s} {4:>10s} {5:>6s} {6:>9s} "
+          "{7:>9s} {8:>9s} {9:>10s}".format(
+              'replay' + (' (abs)' if absolute else ''), 'messages',
+              'keys', 'merged', 'msg/s', 'cpu%', 'p50 ms', 'p99 ms',
+              'max ms', 'out p99 ms'))
+    for name, data in streams:
+        result = bench_replay(data, absolute, rate, cc_window)
+        (_, p50, p99, top) = result['stats'].summary('total')
+        output_p99 = result['stats'].summary('output')[2]
+        print("{0:<20s} {1:>9d} {2:>9d} {3:>9d} {4:>10.0f} {5:>6.0f} "
+              "{6:>9.3f} {7:>9.3f} {8:>9.3f} {9:>10.3f}".format(
+                  name, result['messages'], result['events'],
+                  result['merged'],
+                  result['messages'] / result['elapsed'],
+                  100 * result['cpu'] / result['elapsed'],
+                  p50 * 1e3, p99 * 1e3, top * 1e3, output_p99 * 1e3))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='midi2dt benchmarks')
+    parser.add_argument(
+        'streams', nargs='*',
+        help='synthetic stream names (%s) or raw MIDI files '
+        '(default: all synthetic streams)' % ', '.join(STREAMS))
+    parser.add_argument('-b', '--bench', action='append',
+                        choices=('parser', 'lookup', 'translate', 'replay'),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help='note count of synthetic streams')
+    parser.add_argument('--abs', action='store_true',
+                        help='translate and replay with absolute '
+                        'controllers')
+    parser.add_argument('--rate', type=int, default=0,
+                        help='replay rate in bytes/s (default: max speed)')
+    parser.add_argument('--cc-window', type=float, default=0,
+                        help='controller coalescing window in ms')
+    parser.add_argument('-c', '--config', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'configs.json'),
+        help='bindings used by the lookup benchmark')
+    args = parser.parse_args(argv)
+
+    benches = args.bench or ('parser', 'lookup', 'translate', 'replay')
+    streams = load_streams(args.streams or list(STREAMS), args.count)
+    if 'parser' in benches:
+        run_parser(streams)
+        print()
+    if 'lookup' in benches:
+        bench_lookup(midi2dt.load_bindings(args.config))
+        print()
+    if 'translate' in benches:
+        run_translate(streams, args.abs)
+        print()
+    if 'replay' in benches:
+        run_replay(streams, args.abs, args.rate, args.cc_window / 1e3)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
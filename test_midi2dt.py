@@ -0,0 +1,864 @@
+#!/usr/bin/python3
+# Tests of midi2dt, no MIDI hardware nor X server needed: a FIFO stands in
+# for the device
+import json
+import marshal
+import os
+import select
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import midi2dt
+
+
+def parse(data, realtime=False):
+    return [tuple(message[:3]) for message in
+            midi2dt.MidiParser(realtime).feed(bytes(data))]
+
+
+def message(status, data1, data2=0, device=''):
+    return midi2dt.MidiMessage(status, data1, data2, time.monotonic(), device)
+
+
+class ParserTest(unittest.TestCase):
+
+    def test_running_status(self):
+        self.assertEqual(
+            parse([0x90, 60, 50, 62, 51, 0xB1, 1, 10, 2, 20]),
+            [(0x90, 60, 50), (0x90, 62, 51), (0xB1, 1, 10), (0xB1, 2, 20)])
+
+    def test_realtime_inside_message(self):
+        data = [0x90, 0xF8, 60, 0xF8, 50, 0xFE]
+        self.assertEqual(parse(data), [(0x90, 60, 50)])
+        self.assertEqual(
+            parse(data, realtime=True),
+            [(0xF8, 0, 0), (0xF8, 0, 0), (0x90, 60, 50), (0xFE, 0, 0)])
+
+    def test_sysex(self):
+        # data bytes of the dump are skipped, and so are the ones after it
+        # until a status byte
+        self.assertEqual(
+            parse([0x90, 60, 50, 0xF0, 1, 2, 0x90, 3, 0xF7, 61, 51,
+                   0x80, 60, 0]),
+            [(0x90, 60, 50), (0x80, 60, 0)])
+
+    def test_one_byte_messages(self):
+        self.assertEqual(
+            parse([0xC0, 5, 6, 0xD2, 100, 0xE0, 0, 64]),
+            [(0xC0, 5, 0), (0xC0, 6, 0), (0xD2, 100, 0), (0xE0, 0, 64)])
+
+    def test_system_common_cancels_running_status(self):
+        self.assertEqual(
+            parse([0x90, 60, 50, 0xF1, 3, 61, 51, 0xF3, 1, 0x90, 62, 52]),
+            [(0x90, 60, 50), (0x90, 62, 52)])
+
+    def test_message_split_across_reads(self):
+        parser = midi2dt.MidiParser()
+        messages = []
+        for byte in (0x90, 60, 50, 62, 51):
+            messages.extend(parser.feed(bytes((byte,))))
+        self.assertEqual([tuple(m[:3]) for m in messages],
+                         [(0x90, 60, 50), (0x90, 62, 51)])
+
+
+class MidiKeyboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        self.fifo = os.path.join(self.tmpdir, 'midi')
+        os.mkfifo(self.fifo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, *chunks):
+        # write the chunks 0.1 s apart, then close the FIFO
+        fd = os.open(self.fifo, os.O_WRONLY)
+        for (i, chunk) in enumerate(chunks):
+            if i:
+                time.sleep(0.1)
+            os.write(fd, bytes(chunk))
+        os.close(fd)
+
+    def read_all(self, midikb):
+        # the messages read until the reader stops, woken up by the reader
+        messages = []
+        deadline = time.monotonic() + 5
+        running = True
+        while running and time.monotonic() < deadline:
+            select.select([midikb.fileno()], [], [], 0.5)
+            running = midikb.is_running()
+            messages.extend(midikb.read())
+        midikb.close()
+        self.assertFalse(running)
+        return messages
+
+    def test_fifo(self):
+        midikb = midi2dt.MidiKeyboard(self.fifo)
+        self.write([0x90, 60, 50, 0xF8, 0x80, 60, 0, 0xB0, 1, 64])
+        messages = self.read_all(midikb)
+        self.assertEqual(
+            [tuple(m[:3]) for m in messages],
+            [(0x90, 60, 50), (0x80, 60, 0), (0xB0, 1, 64),
+             (midi2dt.DEVICE_RESET, 0, 0)])
+
+    def test_block_policy_wakes_up_the_consumer(self):
+        # a single read holding more messages than the queue
+        midikb = midi2dt.MidiKeyboard(
+            self.fifo, queue_size=16, policy='block')
+        self.write([0x90, 60, 50] * 200)
+        messages = self.read_all(midikb)
+        self.assertEqual(len(messages), 201)
+        self.assertEqual(midikb.counters()['midi dropped'], 0)
+
+    def test_reconnect_backoff(self):
+        def hang_up():
+            # each time the reader opens the FIFO, an end of stream
+            while not done.is_set():
+                os.close(os.open(self.fifo, os.O_WRONLY))
+
+        done = threading.Event()
+        writer = threading.Thread(target=hang_up, daemon=True)
+        writer.start()
+        # a device node, which comes back
+        with mock.patch.object(midi2dt.stat, 'S_ISCHR', return_value=True):
+            midikb = midi2dt.MidiKeyboard(self.fifo)
+            time.sleep(1)
+            resets = len(midikb.read())
+            midikb.close()
+        done.set()
+        os.close(os.open(self.fifo, os.O_RDONLY | os.O_NONBLOCK))
+        writer.join(1)
+        # opened 0, 0.1, 0.3 and 0.7 s after the start, not every 0.1 s
+        self.assertLessEqual(resets, 5)
+
+    def test_devices(self):
+        other = os.path.join(self.tmpdir, 'midi2')
+        os.mkfifo(other)
+        midikb = midi2dt.MidiKeyboard(self.fifo)
+        midikb.add_device(other)
+        # running status and messages in progress are kept per device
+        fd = os.open(other, os.O_WRONLY)
+        os.write(fd, bytes([0xB0, 1, 10, 2]))
+        self.write([0x90, 60, 50, 62])
+        os.write(fd, bytes([20]))
+        os.close(fd)
+        messages = self.read_all(midikb)
+        self.assertEqual(
+            sorted((m.device, tuple(m[:3])) for m in messages),
+            sorted([(self.fifo, (0x90, 60, 50)), (other, (0xB0, 1, 10)),
+                    (other, (0xB0, 2, 20)),
+                    (self.fifo, (midi2dt.DEVICE_RESET, 0, 0)),
+                    (other, (midi2dt.DEVICE_RESET, 0, 0))]))
+
+    def test_record_and_replay(self):
+        session = os.path.join(self.tmpdir, 'session.m2dt')
+        midikb = midi2dt.MidiKeyboard(
+            self.fifo, recorder=midi2dt.SessionRecorder(session))
+        # a message split across the chunks
+        self.write([0x90, 60, 50, 0x90], [62, 51], [0x80, 60, 0])
+        recorded = [tuple(m[:3]) for m in self.read_all(midikb)]
+        # and the reset of the device closed
+        self.assertEqual(len(recorded), 4)
+        start = time.monotonic()
+        replay = midi2dt.ReplayKeyboard(session)
+        # a device added does not cut the delays short
+        replay.add_device(self.fifo)
+        replayed = self.read_all(replay)
+        self.assertEqual([tuple(m[:3]) for m in replayed], recorded)
+        # with the timing of the chunks, 0.1 s apart
+        self.assertGreater(replayed[-1].time - replayed[0].time, 0.15)
+        self.assertGreater(time.monotonic() - start, 0.15)
+        start = time.monotonic()
+        replayed = self.read_all(midi2dt.ReplayKeyboard(session, speed=0))
+        self.assertEqual([tuple(m[:3]) for m in replayed], recorded)
+        self.assertLess(time.monotonic() - start, 0.15)
+
+    def test_record_and_replay_devices(self):
+        session = os.path.join(self.tmpdir, 'session.m2dt')
+        other = os.path.join(self.tmpdir, 'midi2')
+        os.mkfifo(other)
+        midikb = midi2dt.MidiKeyboard(
+            self.fifo, recorder=midi2dt.SessionRecorder(session))
+        midikb.add_device(other)
+        # running status and messages in progress of each device
+        fd = os.open(other, os.O_WRONLY)
+        os.write(fd, bytes([0xB0, 1, 10, 2]))
+        self.write([0x90, 60, 50, 62])
+        os.write(fd, bytes([20]))
+        os.close(fd)
+        recorded = sorted(
+            (m.device, tuple(m[:3])) for m in self.read_all(midikb))
+        self.assertEqual(len(recorded), 5)
+        replayed = self.read_all(midi2dt.ReplayKeyboard(session, speed=0))
+        self.assertEqual(
+            sorted((m.device, tuple(m[:3])) for m in replayed), recorded)
+
+
+class MessageQueueTest(unittest.TestCase):
+
+    def fill(self, queue, *messages):
+        for status_data in messages:
+            queue.put(message(*status_data))
+
+    def test_drop_oldest(self):
+        queue = midi2dt.MessageQueue(3, 'drop-oldest', 0)
+        self.fill(queue, (0x90, 60, 50), (0x80, 60, 0), (0x90, 61, 50),
+                  (0x90, 62, 50), (0x90, 63, 50))
+        # the release pushed out is read first
+        self.assertEqual([tuple(m[:3]) for m in queue.read()], [
+            (0x80, 60, 0), (0x90, 61, 50), (0x90, 62, 50), (0x90, 63, 50)])
+        self.assertEqual(queue.counters()['midi dropped'], 1)
+        self.assertEqual(queue.read(), [])
+
+    def test_latest(self):
+        queue = midi2dt.MessageQueue(2, 'latest', 0)
+        self.fill(queue, (0xB0, 1, 10), (0xB0, 2, 10), (0xB0, 1, 11),
+                  (0xB0, 1, 12), (0x90, 60, 50))
+        self.assertEqual([tuple(m[:3]) for m in queue.read()], [
+            (0xB0, 2, 10), (0x90, 60, 50)])
+        self.assertEqual(queue.counters()['midi dropped'], 1)
+        self.assertEqual(queue.replaced, 2)
+
+    def test_max_age(self):
+        queue = midi2dt.MessageQueue(8, 'drop-oldest', 0.05)
+        self.fill(queue, (0x90, 60, 50), (0x80, 60, 0))
+        time.sleep(0.1)
+        self.fill(queue, (0x90, 62, 50))
+        # stale, but releases are kept
+        self.assertEqual([tuple(m[:3]) for m in queue.read()], [
+            (0x80, 60, 0), (0x90, 62, 50)])
+        self.assertEqual(queue.stale, 1)
+
+    def test_max_age_after_a_fresh_message(self):
+        queue = midi2dt.MessageQueue(2, 'latest', 0.05)
+        self.fill(queue, (0xB0, 1, 10), (0x90, 60, 50))
+        time.sleep(0.1)
+        # a fresh value in the slot of the oldest message
+        self.fill(queue, (0xB0, 1, 11))
+        self.assertEqual([tuple(m[:3]) for m in queue.read()],
+                         [(0xB0, 1, 11)])
+        self.assertEqual(queue.stale, 1)
+
+    def test_reset_after_close(self):
+        queue = midi2dt.MessageQueue(1, 'block', 0)
+        self.fill(queue, (0x90, 60, 50))
+        queue.close()
+        self.fill(queue, (0x90, 62, 50), (midi2dt.DEVICE_RESET, 0))
+        self.assertEqual([tuple(m[:3]) for m in queue.read()],
+                         [(midi2dt.DEVICE_RESET, 0, 0)])
+        self.assertEqual(queue.counters()['midi dropped'], 2)
+
+
+class KeyMapTest(unittest.TestCase):
+
+    def test_compiled_bindings(self):
+        up = (0xB00 | 1) << 1 | 1
+        keymap = midi2dt.KeyMap({
+            0x900 | 60: ['Note-on', '60', 'Ctrl+', 'c', 0],
+            0x800 | 60: ['Note-off', '60', '-', midi2dt.UNDEFINED_KEY, 1],
+            up: ['CC', '1+', '-', 'Up', 'True']})
+        self.assertEqual(keymap.values[0x900 | 60], 'Ctrl+c')
+        self.assertIsNone(keymap.values[0x800 | 60])
+        self.assertIsNone(keymap.values[0x900 | 61])
+        self.assertEqual(keymap.values[up], 'Up')
+        self.assertEqual(keymap.types[up], 1)
+        self.assertEqual(keymap.types[0x900 | 60], 0)
+
+
+class EngineTest(unittest.TestCase):
+
+    def engine(self, bindings, absolute=False, cc_window=0):
+        self.output = midi2dt.RecordingBackend()
+        engine = midi2dt.Engine(
+            midi2dt.KeyMap(bindings), self.output, absolute,
+            cc_window=cc_window, chord_window=0.03, profile='')
+        self.addCleanup(engine.close)
+        return engine
+
+    def events(self):
+        (events, self.output.events) = (self.output.events, [])
+        return events
+
+    def test_notes(self):
+        engine = self.engine({
+            0x900 | 60: ['Note-on', 60, '-', 'a', 0],
+            0x900 | 60 | midi2dt.NOTE_PRESSURE_STRONG_DELTA << 12:
+                ['Note-on', 60, '-', 'A', 0],
+            0x900 | 62: ['Note-on', 62, 'Ctrl+', 'b', 1],
+            0x800 | 62: ['Note-off', 62, '-', 'c', 1]})
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0),
+                        message(0x90, 60, 120), message(0x90, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'a'), ('keyup', 'a'),
+            ('keydown', 'A'), ('keyup', 'A')])
+        # state 1: a key on press, another on release
+        engine.process([message(0x90, 62, 50), message(0x80, 62, 0)])
+        self.assertEqual(self.events(), [('key', 'Ctrl+b'), ('key', 'c')])
+
+    def test_relative_cc(self):
+        engine = self.engine({
+            (0xB00 | 1) << 1: ['CC', 1, '-', 'Down', 0],
+            (0xB00 | 1) << 1 | 1: ['CC', 1, '-', 'Up', 0]})
+        # no key for the first value: no direction yet; the moves of a
+        # batch are merged
+        for value in (10, 11, 12, 5):
+            engine.process([message(0xB0, 1, value)])
+        self.assertEqual(self.events(), [
+            ('key', 'Up'), ('key', 'Up'), ('key', 'Down')])
+
+    def cc_engine(self, options=None, cc_window=0):
+        engine = self.engine({
+            (0xB00 | 1) << 1: ['CC', 1, '-', 'Down', 0, options or {}],
+            (0xB00 | 1) << 1 | 1: ['CC', 1, '-', 'Up', 0, options or {}]},
+            cc_window=cc_window)
+        engine.process([message(0xB0, 1, 10)])
+        return engine
+
+    def test_cc_batch(self):
+        engine = self.cc_engine()
+        engine.process([message(0xB0, 1, value)
+                        for value in (11, 12, 13, 14, 12)])
+        # a net count of keys
+        self.assertEqual(self.events(), [('key', 'Up')] * 3)
+        self.assertEqual(engine.counters()['cc merged'], 4)
+
+    def test_cc_window(self):
+        engine = self.cc_engine(cc_window=0.05)
+        engine.process([message(0xB0, 1, 11)])
+        engine.process([message(0xB0, 1, 12)])
+        self.assertEqual(self.events(), [])
+        deadline = engine.next_deadline()
+        self.assertIsNotNone(deadline)
+        engine.tick(deadline)
+        self.assertEqual(self.events(), [('key', 'Up')] * 2)
+        self.assertIsNone(engine.next_deadline())
+
+    def test_rate_drop(self):
+        engine = self.cc_engine({'rate': 10})
+        engine.process([message(0xB0, 1, value) for value in (11, 12, 13)])
+        engine.process([message(0xB0, 1, 14)])
+        self.assertEqual(self.events(), [('key', 'Up')])
+        self.assertEqual(engine.counters()['cc dropped'], 3)
+        self.assertIsNone(engine.next_deadline())
+
+    def test_rate_accumulate(self):
+        engine = self.cc_engine({'rate': 10, 'overflow': 'accumulate'})
+        engine.process([message(0xB0, 1, value) for value in (11, 12, 13)])
+        self.assertEqual(self.events(), [('key', 'Up')])
+        # one more key every 0.1 s
+        for _ in range(2):
+            deadline = engine.next_deadline()
+            engine.tick(deadline - 0.01)
+            self.assertEqual(self.events(), [])
+            engine.tick(deadline + 0.001)
+            self.assertEqual(self.events(), [('key', 'Up')])
+        self.assertIsNone(engine.next_deadline())
+        self.assertEqual(engine.counters()['cc dropped'], 0)
+
+    def test_chord(self):
+        chord = midi2dt.CHORD_KEY | 1 << 60 | 1 << 64
+        engine = self.engine({
+            0x900 | 60: ['Note-on', 60, '-', 'a', 0],
+            0x900 | 64: ['Note-on', 64, '-', 'e', 0],
+            0x900 | 67: ['Note-on', 67, '-', 'g', 0],
+            chord: ['Chord', '60+64', 'Ctrl+', 'c', 0]})
+        engine.process([message(0x90, 60, 50), message(0x90, 64, 50)])
+        engine.process([message(0x80, 60, 0), message(0x80, 64, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'Ctrl+c'), ('keyup', 'Ctrl+c')])
+        # alone, the note is sent once the chord window is over
+        engine.process([message(0x90, 60, 50)])
+        self.assertEqual(self.events(), [])
+        engine.tick(time.monotonic() + 1)
+        engine.process([message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [('keydown', 'a'), ('keyup', 'a')])
+        # notes out of any chord are sent at once
+        engine.process([message(0x90, 67, 50), message(0x80, 67, 0)])
+        self.assertEqual(self.events(), [('keydown', 'g'), ('keyup', 'g')])
+
+    def test_chord_actions(self):
+        chord = midi2dt.CHORD_KEY | 1 << 60 | 1 << 64
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {
+                0x900 | 67: ['Note-on', 67, '-', 'g', 0],
+                chord: ['Chord', '60+64', '-', 'macro:a 10ms b', 0],
+                chord | 1 << 62: ['Chord', '60+62+64', '-', 'layer:fx', 0],
+                chord | 1 << 65: ['Chord', '60+64+65', '-',
+                                  'mouse:button 1', 0]},
+            ('fx', ''): {0x900 | 67: ['Note-on', 67, '-', 'G', 0]}})
+        engine.process([message(0x90, 60, 50), message(0x90, 64, 50)])
+        engine.tick(time.monotonic() + 1)
+        engine.process([message(0x80, 60, 0), message(0x80, 64, 0)])
+        self.assertEqual(self.events(), [('key', 'a'), ('key', 'b')])
+        # a layer held by a chord
+        engine.process([message(0x90, 60, 50), message(0x90, 62, 50),
+                        message(0x90, 64, 50), message(0x90, 67, 50),
+                        message(0x80, 67, 0), message(0x80, 62, 0),
+                        message(0x90, 67, 50), message(0x80, 67, 0)])
+        engine.process([message(0x80, 60, 0), message(0x80, 64, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'G'), ('keyup', 'G'),
+            ('keydown', 'g'), ('keyup', 'g')])
+        # a mouse button held by a chord
+        engine.process([message(0x90, 60, 50), message(0x90, 64, 50),
+                        message(0x90, 65, 50), message(0x80, 64, 0)])
+        engine.process([message(0x80, 60, 0), message(0x80, 65, 0)])
+        self.assertEqual(self.events(), [('mousedown', 1), ('mouseup', 1)])
+
+    def test_device_layouts(self):
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {0x900 | 60: ['Note-on', 60, '-', 'a', 0]},
+            ('', 'pad'): {0x900 | 60: ['Note-on', 60, '-', 'p', 0]}})
+        # and a state per device
+        engine.process([
+            message(0x90, 60, 50), message(0x90, 60, 50, 'pad'),
+            message(0x80, 60, 0, 'pad'), message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'a'), ('keydown', 'p'), ('keyup', 'p'),
+            ('keyup', 'a')])
+
+    def test_layer_switch(self):
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {
+                0x900 | 60: ['Note-on', 60, '-', 'a', 0],
+                0x900 | 62: ['Note-on', 62, '-', 'layer:fx', 0],
+                0x900 | 64: ['Note-on', 64, '-', 'layer:fx', 1]},
+            ('fx', ''): {0x900 | 60: ['Note-on', 60, '-', 'b', 0]}})
+        # held
+        engine.process([message(0x90, 62, 50), message(0x90, 60, 50),
+                        message(0x80, 60, 0), message(0x80, 62, 0),
+                        message(0x90, 60, 50), message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'b'), ('keyup', 'b'),
+            ('keydown', 'a'), ('keyup', 'a')])
+        # toggled
+        engine.process([message(0x90, 64, 50), message(0x80, 64, 0)])
+        self.assertEqual(engine.layer, 'fx')
+        engine.process([message(0x90, 64, 50), message(0x80, 64, 0)])
+        self.assertEqual(engine.layer, '')
+        self.assertEqual(self.events(), [])
+
+    def test_channel_bindings(self):
+        engine = self.engine({
+            0x900 | 60: ['Note-on', 60, '-', 'a', 0],
+            midi2dt.channel_key(0x900 | 60, 9): ['Note-on', 60, '-', 'd', 0]})
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0),
+                        message(0x99, 60, 50), message(0x89, 60, 0),
+                        message(0x93, 60, 50), message(0x83, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'a'), ('keyup', 'a'), ('keydown', 'd'),
+            ('keyup', 'd'), ('keydown', 'a'), ('keyup', 'a')])
+        # the same note held on two channels
+        engine.process([message(0x90, 60, 50), message(0x99, 60, 50),
+                        message(0x80, 60, 0), message(0x89, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'a'), ('keydown', 'd'), ('keyup', 'a'),
+            ('keyup', 'd')])
+
+    def test_cc_hysteresis(self):
+        options = {'zones': [64], 'hysteresis': 4}
+        engine = self.engine(dict(
+            ((zone << 12) | 0xB00 | 1,
+             ['CC', 1, '-', 'k%d' % zone, 1, options])
+            for zone in (1, 2)), absolute=True)
+        engine.process([message(0xB0, 1, v) for v in (60, 66, 70, 62, 50)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'k1'), ('keyup', 'k1'), ('keydown', 'k2'),
+            ('keyup', 'k2'), ('keydown', 'k1')])
+
+    def macro_engine(self, retrigger):
+        return self.engine({0x900 | 60: [
+            'Note-on', 60, '-', 'macro:keydown:Shift a 50ms b keyup:Shift',
+            0, {'retrigger': retrigger}]})
+
+    def test_macro_cancel(self):
+        engine = self.macro_engine('cancel')
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'Shift'), ('key', 'a')])
+        # hit again while it plays: restarted, Shift released first
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keyup', 'Shift'), ('keydown', 'Shift'), ('key', 'a')])
+        engine.tick(engine.next_deadline())
+        self.assertEqual(self.events(), [
+            ('key', 'b'), ('keyup', 'Shift')])
+        self.assertIsNone(engine.next_deadline())
+
+    def test_macro_queue(self):
+        engine = self.macro_engine('queue')
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0),
+                        message(0x90, 60, 50), message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'Shift'), ('key', 'a')])
+        engine.tick(engine.next_deadline())
+        self.assertEqual(self.events(), [
+            ('key', 'b'), ('keyup', 'Shift'),
+            ('keydown', 'Shift'), ('key', 'a')])
+        engine.tick(engine.next_deadline())
+        self.assertEqual(self.events(), [
+            ('key', 'b'), ('keyup', 'Shift')])
+        self.assertIsNone(engine.next_deadline())
+
+    def test_device_reset(self):
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {
+                0x900 | 60: ['Note-on', 60, '-', 'a', 0],
+                0x900 | 62: ['Note-on', 62, '-', 'mouse:button 1', 0],
+                0x900 | 64: ['Note-on', 64, '-', 'layer:fx', 0]},
+            ('fx', ''): {0x900 | 62: ['Note-on', 62, '-', 'b', 0]}})
+        engine.process([message(0x90, 60, 50), message(0x90, 62, 50),
+                        message(0x90, 64, 50)])
+        self.assertEqual(engine.layer, 'fx')
+        self.events()
+        engine.process([message(midi2dt.DEVICE_RESET, 0)])
+        self.assertEqual(sorted(self.events()), [
+            ('keyup', 'a'), ('mouseup', 1)])
+        self.assertEqual(engine.layer, '')
+        # nothing left to release
+        engine.process([message(0x80, 60, 0),
+                        message(midi2dt.DEVICE_RESET, 0)])
+        self.assertEqual(self.events(), [])
+
+    def test_release_whatever_the_layer(self):
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {
+                0x900 | 62: ['Note-on', 62, '-', 'mouse:button 1', 0],
+                0x900 | 64: ['Note-on', 64, '-', 'layer:fx', 0]},
+            ('fx', ''): {0x900 | 62: ['Note-on', 62, '-', 'b', 0]}})
+        engine.process([message(0x90, 62, 50), message(0x90, 64, 50),
+                        message(0x80, 62, 0)])
+        self.assertEqual(self.events(), [('mousedown', 1), ('mouseup', 1)])
+
+    def test_no_release_without_press(self):
+        engine = self.engine({})
+        engine.set_layouts({
+            ('', ''): {0x900 | 64: ['Note-on', 64, '-', 'layer:fx', 0]},
+            ('fx', ''): {0x900 | 60: ['Note-on', 60, '-', 'b', 0]}})
+        # pressed unbound, released bound
+        engine.process([message(0x90, 60, 50), message(0x90, 64, 50),
+                        message(0x80, 60, 0)])
+        self.assertEqual(self.events(), [])
+
+    def test_absolute_cc_zones(self):
+        engine = self.engine(dict(
+            ((zone << 12) | 0xB00 | 1, ['CC', 1, '-', 'k%d' % zone, 1])
+            for zone in range(1, 11)), absolute=True)
+        engine.process([message(0xB0, 1, v) for v in (0, 20, 45, 127)])
+        self.assertEqual(self.events(), [
+            ('keydown', 'k1'), ('keyup', 'k1'), ('keydown', 'k2'),
+            ('keyup', 'k2'), ('keydown', 'k4'), ('keyup', 'k4'),
+            ('keydown', 'k10')])
+        engine.process([message(midi2dt.DEVICE_RESET, 0)])
+        self.assertEqual(self.events(), [('keyup', 'k10')])
+
+    def test_close_releases(self):
+        chord = midi2dt.CHORD_KEY | 1 << 60 | 1 << 64
+        engine = self.engine({})
+        engine.set_layouts({('', ''): {
+            0x900 | 62: ['Note-on', 62, '-', 'mouse:button 1', 0],
+            0x900 | 67: ['Note-on', 67, '-', 'g', 0],
+            chord: ['Chord', '60+64', 'Ctrl+', 'c', 0]}})
+        engine.process([message(0x90, 62, 50), message(0x90, 67, 50),
+                        message(0x90, 60, 50), message(0x90, 64, 50)])
+        self.events()
+        engine.close()
+        self.assertEqual(sorted(self.events()), [
+            ('keyup', 'Ctrl+c'), ('keyup', 'g'), ('mouseup', 1)])
+
+
+class SlowBackend(midi2dt.RecordingBackend):
+    # sends once `go` is set
+
+    def __init__(self):
+        midi2dt.RecordingBackend.__init__(self)
+        self.go = threading.Event()
+
+    def send(self, events):
+        self.go.wait(5)
+        midi2dt.RecordingBackend.send(self, events)
+
+
+class AsyncOutputTest(unittest.TestCase):
+
+    def test_order(self):
+        backend = SlowBackend()
+        output = midi2dt.AsyncOutput(backend)
+        for key in 'abc':
+            output.send([('keydown', key), ('keyup', key)])
+        backend.go.set()
+        output.close()
+        self.assertEqual(backend.events, [
+            ('keydown', 'a'), ('keyup', 'a'), ('keydown', 'b'),
+            ('keyup', 'b'), ('keydown', 'c'), ('keyup', 'c')])
+
+    def test_overflow_keeps_keyups(self):
+        backend = SlowBackend()
+        output = midi2dt.AsyncOutput(backend, maxsize=2)
+        output.send([('keydown', 'a')])
+        output.send([('keyup', 'a'), ('keydown', 'b')])
+        output.send([('keydown', 'c')])
+        self.assertEqual(output.counters()['output dropped'], 2)
+        backend.go.set()
+        output.close()
+        self.assertEqual(backend.events, [('keydown', 'a'), ('keyup', 'a')])
+
+    def test_xdotool_calls_in_order(self):
+        tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        log = os.path.join(tmpdir, 'log')
+        # a fake xdotool, slower for the first batch
+        with open(os.path.join(tmpdir, 'xdotool'), 'w') as f:
+            f.write('#!/bin/sh\n[ "$1" = keydown ] && sleep 0.2\n'
+                    'echo "$@" >> %s\n' % log)
+        os.chmod(os.path.join(tmpdir, 'xdotool'), 0o755)
+        path = tmpdir + os.pathsep + os.environ.get('PATH', '')
+        with mock.patch.dict(os.environ, {'PATH': path}):
+            output = midi2dt.XdotoolBackend()
+            output.send([('keydown', 'a')])
+            output.send([('keyup', 'a')])
+        with open(log) as f:
+            self.assertEqual(f.read(), 'keydown a\nkeyup a\n')
+
+
+class ZonesTest(unittest.TestCase):
+
+    def test_zone_bounds(self):
+        self.assertEqual(midi2dt.zone_bounds([100, 40]), [0, 40, 100])
+
+    def test_equal_zones(self):
+        self.assertEqual(midi2dt.zone_bounds(4), [0, 32, 64, 96])
+        self.assertEqual(midi2dt.zone_bounds(1), [0])
+        self.assertRaises(ValueError, midi2dt.zone_bounds, 0)
+
+    def test_velocities_ignore_hysteresis(self):
+        table = midi2dt.compile_zones(0x900, None, 5)
+        self.assertEqual(table, midi2dt.VELOCITY_ZONES)
+
+    def test_default_cc_zones(self):
+        # round(value * 9 / 127) + 1, as before the zones could be set
+        self.assertEqual(midi2dt.CC_ZONES[:128], bytes(
+            round(value * 9 / 127) + 1 for value in range(128)))
+
+    def test_cc_hysteresis(self):
+        table = midi2dt.compile_zones(0xB00, [32, 64, 96], 3)
+        # from zone 1, zone 2 starts 3 values later; without previous zone
+        # at its bound
+        self.assertEqual(table[1 << 7 | 34], 1)
+        self.assertEqual(table[1 << 7 | 35], 2)
+        self.assertEqual(table[32], 2)
+
+
+class CommandRunnerTest(unittest.TestCase):
+
+    def wait_done(self, runner, count):
+        deadline = time.monotonic() + 5
+        while runner.done < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(runner.done, count)
+
+    def test_timeout_and_concurrency(self):
+        runner = midi2dt.CommandRunner(workers=2)
+        self.addCleanup(runner.close)
+        # a second run while the first one is not done is dropped
+        runner.run(('sleep 5', 0.2, 1))
+        runner.run(('sleep 5', 0.2, 1))
+        self.wait_done(runner, 1)
+        self.assertEqual(runner.counters(), {
+            'commands run': 1, 'commands dropped': 1,
+            'commands timed out': 1})
+
+    def test_commands_run_at_once(self):
+        tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        runner = midi2dt.CommandRunner(workers=2)
+        self.addCleanup(runner.close)
+        line = 'sleep 0.1; echo >> %s/runs' % tmpdir
+        runner.run((line, 5, 2))
+        runner.run((line, 5, 2))
+        self.wait_done(runner, 2)
+        with open(os.path.join(tmpdir, 'runs')) as f:
+            self.assertEqual(len(f.readlines()), 2)
+        self.assertEqual(runner.counters()['commands dropped'], 0)
+
+
+class MouseMotionTest(unittest.TestCase):
+
+    def test_frames(self):
+        motion = midi2dt.MouseMotion(rate=10)
+        events = []
+        motion.add(0, 0.4, 0.0)
+        motion.add(0, 0.4, 0.0)
+        motion.add(2, 1, 0.0)
+        motion.flush(events, 0.0)
+        # the fractions wait for the next frames
+        self.assertEqual(events, [('scroll', (0, 1))])
+        motion.add(0, 0.4, 0.01)
+        self.assertAlmostEqual(motion.deadline, 0.1)
+        motion.flush(events, 0.05)
+        self.assertEqual(len(events), 1)
+        motion.flush(events, 0.1)
+        self.assertEqual(events[1:], [('mousemove', (1, 0))])
+        self.assertIsNone(motion.deadline)
+
+
+class WindowFollowerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        path = self.tmpdir + os.pathsep + os.environ.get('PATH', '')
+        patch = mock.patch.dict(os.environ, {'PATH': path})
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.follower = midi2dt.WindowFollower(lambda window_class: None, 60)
+
+    def tearDown(self):
+        self.follower.close()
+        shutil.rmtree(self.tmpdir)
+
+    def tool(self, name, script):
+        # a fake command on the PATH
+        file_name = os.path.join(self.tmpdir, name)
+        with open(file_name, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(file_name, 0o755)
+
+    def test_xdotool(self):
+        self.tool('xdotool', 'echo Firefox\n')
+        self.assertEqual(self.follower.window_class(), 'Firefox')
+
+    def test_old_xdotool(self):
+        # no getwindowclassname before 2021
+        self.tool('xdotool', 'exit 1\n')
+        self.tool('xprop', 'case "$*" in\n'
+                  '-root*) echo "_NET_ACTIVE_WINDOW(WINDOW): window id # '
+                  '0x3a00007";;\n'
+                  '*) echo \'WM_CLASS(STRING) = "navigator", "Firefox"\';;\n'
+                  'esac\n')
+        self.assertEqual(self.follower.window_class(), 'Firefox')
+
+    def test_unknown_class(self):
+        self.tool('xdotool', 'exit 1\n')
+        self.tool('xprop', 'exit 1\n')
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(self.follower.window_class(), '')
+            self.assertEqual(self.follower.window_class(), '')
+        # once
+        self.assertEqual(len(logs.output), 1)
+
+
+class LatencyStatsTest(unittest.TestCase):
+
+    def test_summary(self):
+        stats = midi2dt.LatencyStats()
+        self.assertEqual(stats.summary('total'), (0, 0.0, 0.0, 0.0))
+        for ms in range(100, 0, -1):
+            stats.add('total', ms / 1000.0)
+        (count, p50, p99, top) = stats.summary('total')
+        self.assertEqual(count, 100)
+        self.assertAlmostEqual(p50, 0.051)
+        self.assertAlmostEqual(p99, 0.1)
+        self.assertAlmostEqual(top, 0.1)
+
+    def test_engine_stages(self):
+        stats = midi2dt.LatencyStats()
+        engine = midi2dt.Engine(
+            midi2dt.KeyMap({0x900 | 60: ['Note-on', 60, '-', 'a', 0]}),
+            midi2dt.NullBackend(), False, stats)
+        engine.process([message(0x90, 60, 50), message(0x80, 60, 0)])
+        engine.close()
+        for stage in ('queue', 'translate', 'total'):
+            self.assertEqual(stats.summary(stage)[0], 2)
+        self.assertEqual(stats.summary('dispatch')[0], 1)
+
+
+class DeviceTest(unittest.TestCase):
+
+    def test_device_numbers(self):
+        self.assertEqual(midi2dt.midi_device_numbers('midiC1D2'), (1, 2))
+        self.assertEqual(midi2dt.midi_device_numbers('midi'), (0, 0))
+        self.assertEqual(midi2dt.midi_device_numbers('midi3'), (3, 0))
+        self.assertEqual(midi2dt.midi_device_numbers('dmmidi1'), (1, 0))
+        self.assertEqual(midi2dt.midi_device_numbers('umidi'), (None, None))
+
+    def test_find_devices(self):
+        tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        for name in ('midiC1D0', 'midi1', 'timer'):
+            open(os.path.join(tmpdir, name), 'w').close()
+        scan_dir = midi2dt.scan_dir
+        # tmpdir stands in for /dev/snd
+        with mock.patch.object(
+                midi2dt, 'scan_dir',
+                lambda path: path == '/dev/snd' and scan_dir(tmpdir) or []):
+            with mock.patch.object(midi2dt, 'asound_rawmidi',
+                                   return_value={(1, 0): 'Keys'}):
+                devices = midi2dt.find_midi_devices()
+        self.assertEqual([tuple(device[1:]) for device in devices], [
+            ('Keys', 1, 0), ('Keys', 1, 0)])
+
+
+class ConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='midi2dt-test-')
+        self.config = os.path.join(self.tmpdir, 'configs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, key):
+        with open(self.config, 'w') as f:
+            json.dump([{'tags': ['0x93c'], 'values': [
+                'Note-on', 60, '-', key, 0]}], f)
+
+    def test_cache(self):
+        self.write_config('a')
+        (layouts, keymaps) = midi2dt.load_config(self.config)
+        self.assertTrue(os.path.exists(self.config + '.cache'))
+        # the file is not parsed again while it is unchanged
+        with mock.patch.object(midi2dt, 'load_layouts') as load_layouts:
+            (layouts, keymaps) = midi2dt.load_config(self.config)
+        self.assertFalse(load_layouts.called)
+        self.assertEqual(keymaps[('', '')].values[0x93c], 'a')
+        self.write_config('bc')
+        (layouts, keymaps) = midi2dt.load_config(self.config)
+        self.assertEqual(keymaps[('', '')].values[0x93c], 'bc')
+
+    def test_cache_format(self):
+        self.write_config('a')
+        midi2dt.load_config(self.config)
+        # plain values only
+        with open(self.config + '.cache', 'rb') as f:
+            marshal.loads(f.read())
+        # a broken cache is written again
+        with open(self.config + '.cache', 'wb') as f:
+            f.write(b'\0broken')
+        (layouts, keymaps) = midi2dt.load_config(self.config)
+        self.assertEqual(keymaps[('', '')].values[0x93c], 'a')
+        with open(self.config + '.cache', 'rb') as f:
+            marshal.loads(f.read())
+
+    def test_watcher(self):
+        self.write_config('a')
+        watcher = midi2dt.ConfigWatcher(self.config, interval=0.01)
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.read(), None)
+        self.write_config('bc')
+        self.assertTrue(select.select([watcher], [], [], 5)[0])
+        (layouts, keymaps) = watcher.read()
+        self.assertEqual(keymaps[('', '')].values[0x93c], 'bc')
+
+
+if __name__ == '__main__':
+    unittest.main()